@@ -0,0 +1,290 @@
+"""CPU micro-benchmarks of the VIBERC graph pipeline on random inputs.
+
+    python benchmark.py compile
+    python benchmark.py graph
+    python benchmark.py hgt
+"""
+import time
+import types
+import argparse
+import torch
+from model import (
+    VIBERC,
+    GNN,
+    MultiDimGNN,
+    pool_utterances,
+    spans_to_pos_mask,
+    compile_fn,
+    window_edges,
+    WindowEdgeCache,
+)
+
+
+def time_calls(fn, inputs, repeats):
+    """Return the mean seconds of one pass of fn over every input."""
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for item in inputs:
+            fn(*item)
+    return (time.perf_counter() - start) / repeats
+
+
+def random_window(batch_size, win_size, num_slots, h_dim, l_dim):
+    """Random keepdim_make_graph inputs, with the window slots outside the
+    dialogue of some targets masked like at the edges of a dialogue."""
+    utt_mask = torch.ones(batch_size, win_size)
+    for i in range(batch_size):
+        start, end = sorted(torch.randint(0, win_size // 2 + 1, [2]).tolist())
+        utt_mask[i, :start] = 0
+        utt_mask[i, win_size - end :] = 0
+    return (
+        torch.randn(batch_size, win_size, h_dim),
+        utt_mask,
+        torch.randn(batch_size, win_size, l_dim),
+        torch.randn(batch_size, win_size, l_dim),
+        torch.randn(batch_size, win_size, num_slots, l_dim),
+    )
+
+
+def make_graph_maker():
+    """The VIBERC state keepdim_make_graph reads, without building a VIBERC."""
+    return types.SimpleNamespace(
+        device="cpu", conceptnet=False, edge_cache=WindowEdgeCache()
+    )
+
+
+def bench_compile(args):
+    """Eager against compiled pooling and GNN over batches of varying shapes."""
+    graph_maker = make_graph_maker()
+    graphs = []
+    pools = []
+    for batch_size in range(1, args.batch_size + 1):
+        window = random_window(batch_size, args.win_size, 7, args.h_dim, args.l_dim)
+        graph = VIBERC.keepdim_make_graph(graph_maker, *window)
+        node_feature, node_type, edge_index, edge_type, edge_time = graph
+        graphs.append((node_feature, node_type, edge_time, edge_index, edge_type))
+        seq_len = 64 * batch_size
+        spans = torch.randint(0, seq_len, [args.win_size, batch_size, 2])
+        spans = torch.sort(spans, dim=-1)[0]
+        pools.append(
+            (
+                torch.randn(batch_size, seq_len, args.h_dim),
+                spans_to_pos_mask(spans, seq_len),
+            )
+        )
+
+    gnn = MultiDimGNN(
+        h_dim=args.h_dim,
+        l_dim=args.l_dim,
+        n_heads=8,
+        n_layers=2,
+        num_types=4,
+        num_relations=4,
+        use_RTE=False,
+    ).eval()
+    compiled_gnn = compile_fn(gnn.forward)
+    compiled_pool = compile_fn(pool_utterances)
+    with torch.no_grad():
+        # The first pass over all shapes includes the compilation.
+        warmup = time_calls(compiled_gnn, graphs, 1) + time_calls(
+            compiled_pool, pools, 1
+        )
+        rows = [
+            ("pool", time_calls(pool_utterances, pools, args.repeats)),
+            ("pool compiled", time_calls(compiled_pool, pools, args.repeats)),
+            ("gnn", time_calls(gnn.forward, graphs, args.repeats)),
+            ("gnn compiled", time_calls(compiled_gnn, graphs, args.repeats)),
+        ]
+    print(f"compile warmup over {len(graphs)} shapes: {warmup:.3f}s")
+    for name, seconds in rows:
+        print(f"{name:<16}{seconds * 1000:10.2f} ms/pass")
+
+
+def loop_window_edges(utt_mask, num_slots):
+    """The per-edge loops window_edges replaced, kept as its reference."""
+    batch_size, win_size = utt_mask.shape
+    num_nodes = win_size * (3 + num_slots)
+    edge_index = [[], []]
+    edge_type = []
+    edge_time = []
+    for i in range(batch_size):
+        source = []
+        target = []
+        for j in range(win_size):
+            if utt_mask[i, j] == 0:
+                continue
+            source += [j, j]
+            target += [j + win_size, j + 2 * win_size]
+            edge_type += [0, 0]
+            edge_time += [2, 2]
+        for j in range(win_size):
+            if utt_mask[i, j] == 0:
+                continue
+            for k in range(j, win_size):
+                if utt_mask[i, k] == 0:
+                    continue
+                source.append(j + win_size)
+                target.append(k)
+                edge_type.append(1)
+                edge_time.append(2)
+        for j in range(win_size):
+            if utt_mask[i, j] == 0:
+                continue
+            for k in range(0, j + 1):
+                if utt_mask[i, k] == 0:
+                    continue
+                source.append(j + 2 * win_size)
+                target.append(k)
+                edge_type.append(2)
+                edge_time.append(2)
+        for j in range(win_size):
+            if utt_mask[i, j] == 0:
+                continue
+            s = 3 * win_size + num_slots * j
+            for k in range(s, s + num_slots):
+                source += [k, k]
+                target += [j + win_size, j + 2 * win_size]
+                edge_type += [3, 3]
+                edge_time += [0, 0]
+        edge_index[0] += [j + i * num_nodes for j in source]
+        edge_index[1] += [j + i * num_nodes for j in target]
+    return (
+        torch.LongTensor(edge_index),
+        torch.LongTensor(edge_type),
+        torch.LongTensor(edge_time),
+    )
+
+
+def bench_graph(args):
+    """The loop against the tensorized edge builder as the window grows."""
+    print(f"{'window':<8}{'edges':>8}{'loop ms':>12}{'tensor ms':>12}{'speedup':>10}")
+    for comet_win_size in [1, 2, 4, 6, 8, 12, 16]:
+        win_size = 2 * comet_win_size + 1
+        masks = [
+            (random_window(args.batch_size, win_size, 7, 1, 1)[1], 7)
+            for _ in range(args.repeats)
+        ]
+        for utt_mask, num_slots in masks:
+            expected = loop_window_edges(utt_mask, num_slots)
+            for got, want in zip(window_edges(utt_mask, num_slots), expected):
+                assert torch.equal(got, want), "window_edges differs from the loop"
+        loop_seconds = time_calls(loop_window_edges, masks, 1) / len(masks)
+        tensor_seconds = time_calls(window_edges, masks, 1) / len(masks)
+        print(
+            f"{win_size:<8}{expected[1].shape[0]:>8}{loop_seconds * 1000:>12.2f}"
+            f"{tensor_seconds * 1000:>12.2f}{loop_seconds / tensor_seconds:>9.1f}x"
+        )
+
+
+def hgt_gnns(args, use_RTE):
+    """A two layer GNN of every HGT conv."""
+    gnns = {
+        "multidim_hgt": MultiDimGNN(
+            h_dim=args.h_dim,
+            l_dim=args.l_dim,
+            n_heads=8,
+            n_layers=2,
+            num_types=4,
+            num_relations=4,
+            use_RTE=use_RTE,
+        )
+    }
+    for conv_name in ["hgt", "dense_hgt"]:
+        gnns[conv_name] = GNN(
+            conv_name=conv_name,
+            in_dim=args.h_dim,
+            n_hid=args.h_dim,
+            n_heads=8,
+            n_layers=2,
+            num_types=4,
+            num_relations=4,
+            use_RTE=use_RTE,
+        )
+    return {name: gnn.eval() for name, gnn in gnns.items()}
+
+
+def hgt_graph_variants(graph):
+    """The graph, and versions of it with an empty node type and a node type
+    without outgoing edges, whose empty segments the fused path must handle."""
+    node_feature, node_type, edge_time, edge_index, edge_type = graph
+    keep = edge_type != 3
+    return [
+        graph,
+        (
+            node_feature,
+            node_type.masked_fill(node_type == 3, 1),
+            edge_time,
+            edge_index,
+            edge_type,
+        ),
+        (
+            node_feature,
+            node_type,
+            edge_time[keep],
+            edge_index[:, keep],
+            edge_type[keep],
+        ),
+    ]
+
+
+def bench_hgt(args):
+    """The masked against the fused HGT messages, over batches of varying size."""
+    graph_maker = make_graph_maker()
+    graphs = []
+    for batch_size in range(1, args.batch_size + 1):
+        window = random_window(batch_size, args.win_size, 7, args.h_dim, args.l_dim)
+        graph = VIBERC.keepdim_make_graph(graph_maker, *window)
+        node_feature, node_type, edge_index, edge_type, edge_time = graph
+        graphs.append((node_feature, node_type, edge_time, edge_index, edge_type))
+
+    def run(gnn, fused, split=False):
+        def forward(node_feature, node_type, *edges):
+            for gc in gnn.gcs:
+                getattr(gc, "base_conv", gc).fused = fused
+            if not split:
+                return gnn(node_feature, node_type, *edges)
+            # The per-type storage of the same nodes, on the MultiDimGNN.
+            is_h = gnn.gcs[0].is_h_type(node_type)
+            h_feature = node_feature[is_h]
+            l_feature = node_feature[~is_h][:, : args.l_dim]
+            h_xs, l_xs, _ = gnn.forward_split(h_feature, l_feature, node_type, *edges)
+            return torch.cat([h_xs.flatten(), l_xs.flatten()])
+
+        return forward
+
+    rows = []
+    with torch.no_grad():
+        for use_RTE in [False, True]:
+            for name, gnn in hgt_gnns(args, use_RTE).items():
+                for graph in graphs:
+                    for variant in hgt_graph_variants(graph):
+                        for split in [False, True][: 1 + (name == "multidim_hgt")]:
+                            expected = run(gnn, False, split)(*variant)
+                            got = run(gnn, True, split)(*variant)
+                            assert torch.allclose(
+                                got, expected, atol=1e-5
+                            ), f"fused {name} differs, use_RTE={use_RTE}, split={split}"
+                if not use_RTE:
+                    for fused, label in [(False, name), (True, name + " fused")]:
+                        seconds = time_calls(run(gnn, fused), graphs, args.repeats)
+                        rows.append((label, seconds))
+    print("fused outputs match the masked ones")
+    for name, seconds in rows:
+        print(f"{name:<20}{seconds * 1000:10.2f} ms/pass")
+
+
+BENCHMARKS = {"compile": bench_compile, "graph": bench_graph, "hgt": bench_hgt}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--batch_size", default=8, type=int)
+    parser.add_argument("--win_size", default=11, type=int)
+    parser.add_argument("--h_dim", default=256, type=int)
+    parser.add_argument("--l_dim", default=128, type=int)
+    parser.add_argument("--repeats", default=5, type=int)
+    parser.add_argument("--threads", default=1, type=int)
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    BENCHMARKS[args.benchmark](args)
@@ -1,4 +1,5 @@
 import random
+import argparse
 
 import nltk
 import nltk.data
@@ -116,7 +117,7 @@ class ErcDatasetComet(torch.utils.data.Dataset):
         return self._create_input(diaids=diaids)
 
 
-def comet_atomic_feature_extract(dataset_name, save_dir):
+def comet_atomic_feature_extract(dataset_name, save_dir, dtype=np.float32):
     extractor = CSKFeatureExtractor()
 
     for part in ["train", "val", "test"]:
@@ -126,7 +127,7 @@ def comet_atomic_feature_extract(dataset_name, save_dir):
         for j, dialogue in enumerate(dataset.data):
             inputs = [utt["text"] for utt in dialogue]
             extracted_dialogue = []
-            features = extractor.extract(inputs)
+            features = extractor.extract(inputs, dtype)
             for i, utt in enumerate(dialogue):
                 utt["atomic_features"] = features[i]
                 extracted_dialogue.append(utt)
@@ -142,7 +143,7 @@ def comet_atomic_feature_extract(dataset_name, save_dir):
         )
 
 
-def RECCON_get_csk_feature():
+def RECCON_get_csk_feature(dtype=np.float32):
     extractor = CSKFeatureExtractor()
     for split in ["train", "val", "test"]:
         target_context, speaker, cause_label, emotion, ids = pickle.load(
@@ -151,7 +152,7 @@ def RECCON_get_csk_feature():
         extracted_data = {}
         for j, id in enumerate(ids):
             dialogue = target_context[id]
-            features = extractor.extract(dialogue)
+            features = extractor.extract(dialogue, dtype)
             extracted_data[id] = features
             if j % 100 == 0:
                 print("{} dialogues processed.".format(j))
@@ -166,4 +167,12 @@ if __name__ == "__main__":
     # make_depression_comet_data("./depression")
     # make_comet_data("./dreaddit/dreaddit-train.csv", None)
     # read_sad_data("./SAD/train.csv")
-    RECCON_get_csk_feature()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--feature_dtype",
+        default="float32",
+        choices=["float32", "float16"],
+        help="The dtype the knowledge features are stored in.",
+    )
+    args = parser.parse_args()
+    RECCON_get_csk_feature(np.dtype(args.feature_dtype))
@@ -55,7 +55,13 @@ class CSKFeatureExtractor:
         batch["attention_mask"] = data.atomic_data.make_attention_mask(XMB)
         return batch
 
-    def extract(self, sentences):
+    def extract(self, sentences, dtype=np.float32):
+        """
+        :param sentences: The utterances of one dialogue.
+        :param dtype: The numpy dtype the features are stored in, e.g. np.float16
+            to halve the size of the extracted data.
+        :return: One [9, D] feature array per sentence.
+        """
         atomic_keys = [
             "xIntent",
             "xAttr",
@@ -85,7 +91,7 @@ class CSKFeatureExtractor:
                 self.opt, self.data_loader.vocab_encoder, XMB.unsqueeze(-1)
             )
             h, _ = self.model(XMB.unsqueeze(1), sequence_mask=MMB)
-            feature = h[:, -1, :].detach().cpu().numpy()
+            feature = h[:, -1, :].detach().cpu().numpy().astype(dtype)
             features.append(feature)
             # last_index = MMB[0][:-1].nonzero()[-1].cpu().numpy()[0] + 1
 
@@ -1,5 +1,6 @@
 import pickle
 import argparse
+import numpy as np
 import torch
 import os
 from transformers import AutoTokenizer, AutoModel
@@ -42,12 +43,19 @@ if __name__ == "__main__":
     parser.add_argument("--cuda", default=False)
     parser.add_argument("--split", default="train")
     parser.add_argument("--tokenizer_dir", default="roberta-base")
+    parser.add_argument(
+        "--feature_dtype",
+        default="float32",
+        choices=["float32", "float16"],
+        help="The dtype the knowledge representations are stored in.",
+    )
     args = parser.parse_args()
 
     dataset = args.dataset
     split = args.split
     cuda = args.cuda
     tokenizer_dir = args.tokenizer_dir
+    feature_dtype = np.dtype(args.feature_dtype)
 
     encoder = AutoModel.from_pretrained(tokenizer_dir)
     if cuda:
@@ -92,7 +100,7 @@ if __name__ == "__main__":
                     sen_know_rep.append(results.detach().cpu().numpy().tolist())
                 if len(sen_know_rep) == 0:
                     sen_know_rep.append(none_rep)
-                dialogue_know_rep.append(sen_know_rep)
+                dialogue_know_rep.append(np.asarray(sen_know_rep, dtype=feature_dtype))
                 num += 1
                 if num % 20 == 0:
                     print(num)
@@ -125,6 +133,9 @@ if __name__ == "__main__":
                 # print(new_sen['knowledge_representation'])
                 if len(new_sen["knowledge_representation"]) == 0:
                     new_sen["knowledge_representation"].append(none_rep)
+                new_sen["knowledge_representation"] = np.asarray(
+                    new_sen["knowledge_representation"], dtype=feature_dtype
+                )
                 new_dialogue.append(new_sen)
                 num += 1
                 if num % 20 == 0:
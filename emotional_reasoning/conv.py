@@ -9,6 +9,154 @@ from torch_geometric.utils import softmax
 import math
 
 
+def segment_apply(fns, types, counts, *inputs):
+    """
+        Apply fns[t] to the rows of inputs of type t, with one call per type for
+        all its rows instead of one call per boolean mask.
+        counts is the list of the number of rows of every type. The outputs are
+        zero-padded in the last dimension to the widest type and returned in
+        the original row order.
+    """
+    order = torch.argsort(types)
+    segments = zip(*[item[order].split(counts) for item in inputs])
+    outputs = [fn(*segment) for fn, segment in zip(fns, segments)]
+    width = max(output.shape[-1] for output in outputs)
+    sorted_out = torch.cat(
+        [F.pad(output, (0, width - output.shape[-1])) for output in outputs]
+    )
+    out = torch.empty_like(sorted_out)
+    out[order] = sorted_out
+    return out
+
+
+def fused_hgt_aggregate(
+    conv, stores, store_types, edge_index, edge_type, edge_time, type_dims, rte_embs
+):
+    """
+        The attention and message passing of the HGT message functions, fused.
+        Instead of masking the edges of each <source type, relation, target
+        type> combination, the K/Q/V projections run once per node type over all
+        its nodes, and the relation transforms once per relation over all its
+        edges. The segment sizes are read from the device once.
+        The nodes are the rows of one or more stores, e.g. one per node width;
+        store_types holds the node type of every row of each store, and
+        edge_index refers to the rows of the stores concatenated.
+        type_dims holds the input width and head width of every node type, and
+        rte_embs the temporal encoding of every source type when use_RTE is set.
+        Returns the aggregated messages of every row, zero-padded to the widest
+        head like the message functions. Dim: [N, n_heads, max head width]
+    """
+    source, target = edge_index
+    num_types = len(type_dims)
+    num_rows = sum(store.size(0) for store in stores)
+    n_heads = conv.n_heads
+    row_type = torch.cat(store_types)
+    counts = [torch.bincount(types, minlength=num_types) for types in store_types]
+    counts.append(torch.bincount(edge_type, minlength=conv.num_relations))
+    if conv.use_RTE:
+        counts.append(torch.bincount(row_type[source], minlength=num_types))
+    counts = torch.cat(counts).tolist()
+    store_counts = [
+        counts[s * num_types : (s + 1) * num_types] for s in range(len(stores))
+    ]
+    counts = counts[len(stores) * num_types :]
+    relation_counts = counts[: conv.num_relations]
+    source_counts = counts[conv.num_relations :]
+
+    def projection(linears, t, rte=None):
+        in_dim, d_k = type_dims[t]
+
+        def project(x, *time):
+            x = x[:, :in_dim]
+            if rte is not None:
+                x = rte(x, time[0])
+            return linears[t](x).view(x.shape[0], n_heads, d_k)
+
+        return project
+
+    def pad_cat(tensors):
+        width = max(tensor.shape[-1] for tensor in tensors)
+        return torch.cat(
+            [F.pad(tensor, (0, width - tensor.shape[-1])) for tensor in tensors]
+        )
+
+    def project_rows(linears):
+        """Project every row of every store with the linear of its node type."""
+        fns = [projection(linears, t) for t in range(num_types)]
+        return pad_cat(
+            [
+                segment_apply(fns, types, type_counts, store)
+                for store, types, type_counts in zip(stores, store_types, store_counts)
+            ]
+        )
+
+    def project_sources(linears):
+        """Project the source row of every edge, after its temporal encoding."""
+        fns = [projection(linears, t, rte_embs[t]) for t in range(num_types)]
+        source_inp = pad_cat(stores)[source]
+        return segment_apply(
+            fns, row_type[source], source_counts, source_inp, edge_time
+        )
+
+    q_mat = project_rows(conv.q_linears)[target]
+    if conv.use_RTE:
+        # The temporal encoding is added per edge, before the source projections.
+        k_mat = project_sources(conv.k_linears)
+        v_mat = project_sources(conv.v_linears)
+    else:
+        k_mat = project_rows(conv.k_linears)[source]
+        v_mat = project_rows(conv.v_linears)[source]
+
+    def relation(r):
+        relation_att = conv.relation_att[r]
+        relation_msg = conv.relation_msg[r]
+        dks, dkt = relation_att.shape[1], relation_att.shape[2]
+
+        def transform(q, k, v):
+            k = torch.bmm(k[:, :, :dks].transpose(1, 0), relation_att).transpose(1, 0)
+            att = (q[:, :, :dkt] * k).sum(dim=-1) * conv.relation_pri[r]
+            att = att / math.sqrt(dkt)
+            msg = torch.bmm(v[:, :, :dks].transpose(1, 0), relation_msg).transpose(1, 0)
+            # Carry the attention logit in front of the message of every head.
+            return torch.cat([att.unsqueeze(-1), msg], dim=-1)
+
+        return transform
+
+    out = segment_apply(
+        [relation(r) for r in range(conv.num_relations)],
+        edge_type,
+        relation_counts,
+        q_mat,
+        k_mat,
+        v_mat,
+    )
+    conv.att = softmax(out[:, :, 0], target, num_nodes=num_rows)
+    msg = out[:, :, 1:] * conv.att.unsqueeze(-1)
+    aggr_out = msg.new_zeros(num_rows, n_heads, msg.shape[-1])
+    aggr_out.index_add_(0, target, msg)
+    return aggr_out
+
+
+def fused_hgt_propagate(
+    conv, node_inp, node_type, edge_index, edge_type, edge_time, type_dims, rte_embs
+):
+    """
+        fused_hgt_aggregate over a single store of all nodes.
+        Dim: [N, n_heads * max head width]
+    """
+    aggr_out = fused_hgt_aggregate(
+        conv,
+        [node_inp],
+        [node_type],
+        edge_index,
+        edge_type,
+        edge_time,
+        type_dims,
+        rte_embs,
+    )
+    return aggr_out.view(node_inp.size(0), -1)
+
+
 class HGTConv(MessagePassing):
     """
         The original HGT model.
@@ -24,6 +172,7 @@ class HGTConv(MessagePassing):
         dropout=0.2,
         use_norm=True,
         use_RTE=True,
+        fused=False,
         **kwargs
     ):
         super(HGTConv, self).__init__(node_dim=0, aggr="add", **kwargs)
@@ -38,6 +187,7 @@ class HGTConv(MessagePassing):
         self.sqrt_dk = math.sqrt(self.d_k)
         self.use_norm = use_norm
         self.use_RTE = use_RTE
+        self.fused = fused
         self.att = None
 
         self.k_linears = nn.ModuleList()
@@ -73,6 +223,18 @@ class HGTConv(MessagePassing):
         glorot(self.relation_msg)
 
     def forward(self, node_inp, node_type, edge_index, edge_type, edge_time):
+        if self.fused:
+            aggr_out = fused_hgt_propagate(
+                self,
+                node_inp,
+                node_type,
+                edge_index,
+                edge_type,
+                edge_time,
+                [(self.in_dim, self.d_k)] * self.num_types,
+                [self.emb if self.use_RTE else None] * self.num_types,
+            )
+            return self.update(aggr_out, node_inp, node_type)
         return self.propagate(
             edge_index,
             node_inp=node_inp,
@@ -200,6 +362,7 @@ class MultiDimHGT(MessagePassing):
         dropout=0.2,
         use_norm=True,
         use_RTE=True,
+        fused=False,
         **kwargs
     ):
         super(MultiDimHGT, self).__init__(node_dim=0, aggr="add", **kwargs)
@@ -216,6 +379,7 @@ class MultiDimHGT(MessagePassing):
         self.sqrt_dkl = math.sqrt(self.d_kl)
         self.use_norm = use_norm
         self.use_RTE = use_RTE
+        self.fused = fused
         self.att = None
 
         self.k_linears = nn.ModuleList()
@@ -288,6 +452,17 @@ class MultiDimHGT(MessagePassing):
         glorot(self.relation_msg)
 
     def forward(self, node_inp, node_type, edge_index, edge_type, edge_time):
+        if self.fused:
+            aggr_out = fused_hgt_propagate(
+                self,
+                node_inp,
+                node_type,
+                edge_index,
+                edge_type,
+                edge_time,
+                *self.fused_type_dims()
+            )
+            return self.update(aggr_out, node_inp, node_type)
         return self.propagate(
             edge_index,
             node_inp=node_inp,
@@ -391,6 +566,157 @@ class MultiDimHGT(MessagePassing):
         agg_input = torch.reshape(agg_input, [-1, self.n_heads, self.d_kh])
         return agg_input[:, :, : self.d_kl].reshape(agg_input.shape[0], -1)
 
+    def fused_type_dims(self):
+        """The type_dims and rte_embs of fused_hgt_aggregate."""
+        type_dims = []
+        rte_embs = []
+        for t in range(self.num_types):
+            if t in self.h_types:
+                type_dims.append((self.h_dim, self.d_kh))
+                rte_embs.append(self.emb[0] if self.use_RTE else None)
+            else:
+                type_dims.append((self.l_dim, self.d_kl))
+                rte_embs.append(self.emb[1] if self.use_RTE else None)
+        return type_dims, rte_embs
+
+    def forward_split(
+        self, h_inp, l_inp, node_type, local_index, edge_index, edge_type, edge_time
+    ):
+        """
+            The layer on per-type node storage: h-type nodes are rows of h_inp
+            [N_h, h_dim] and l-type nodes rows of l_inp [N_l, l_dim], without
+            padding to h_dim. local_index maps every node to its row in its store.
+            Computes the same attention and messages as forward.
+        """
+        is_h = self.is_h_type(node_type)
+        if self.fused:
+            # Address the nodes as rows of the h store followed by the l store.
+            node_row = torch.where(is_h, local_index, local_index + h_inp.size(0))
+            aggr_out = fused_hgt_aggregate(
+                self,
+                [h_inp, l_inp],
+                [node_type[is_h], node_type[~is_h]],
+                node_row[edge_index],
+                edge_type,
+                edge_time,
+                *self.fused_type_dims()
+            )
+            return self.update_split(
+                aggr_out[: h_inp.size(0)].reshape(-1, self.h_dim),
+                aggr_out[h_inp.size(0) :, :, : self.d_kl].reshape(-1, self.l_dim),
+                h_inp,
+                l_inp,
+                node_type,
+            )
+        source, target = edge_index
+        target_is_h = is_h[target]
+        # Every message is stored at the rank of its edge among the edges into
+        # nodes of the same store, at the width of the target type.
+        edge_rank = torch.where(
+            target_is_h,
+            torch.cumsum(target_is_h, dim=0) - 1,
+            torch.cumsum(~target_is_h, dim=0) - 1,
+        )
+        num_h_edges = int(target_is_h.sum())
+        res_att = torch.zeros(edge_type.size(0), self.n_heads).to(h_inp.device)
+        msg_h = torch.zeros(num_h_edges, self.n_heads, self.d_kh).to(h_inp.device)
+        msg_l = torch.zeros(
+            edge_type.size(0) - num_h_edges, self.n_heads, self.d_kl
+        ).to(h_inp.device)
+
+        source_type_all = node_type[source]
+        target_type_all = node_type[target]
+        for source_type in range(self.num_types):
+            if source_type in self.h_types:
+                source_store, dks, emb_num = h_inp, self.d_kh, 0
+            else:
+                source_store, dks, emb_num = l_inp, self.d_kl, 1
+            sb = source_type_all == int(source_type)
+            k_linear = self.k_linears[source_type]
+            v_linear = self.v_linears[source_type]
+            for target_type in range(self.num_types):
+                if target_type in self.h_types:
+                    target_store, dkt, sqrt_dkt = h_inp, self.d_kh, self.sqrt_dkh
+                    msg_store = msg_h
+                else:
+                    target_store, dkt, sqrt_dkt = l_inp, self.d_kl, self.sqrt_dkl
+                    msg_store = msg_l
+                tb = (target_type_all == int(target_type)) & sb
+                q_linear = self.q_linears[target_type]
+                for relation_type in range(self.num_relations):
+                    idx = (edge_type == int(relation_type)) & tb
+                    if idx.sum() == 0:
+                        continue
+                    target_node_vec = target_store[local_index[target[idx]]]
+                    source_node_vec = source_store[local_index[source[idx]]]
+                    if self.use_RTE:
+                        source_node_vec = self.emb[emb_num](
+                            source_node_vec, edge_time[idx]
+                        )
+                    q_mat = q_linear(target_node_vec).view(-1, self.n_heads, dkt)
+                    k_mat = k_linear(source_node_vec).view(-1, self.n_heads, dks)
+                    k_mat = torch.bmm(
+                        k_mat.transpose(1, 0), self.relation_att[relation_type]
+                    ).transpose(1, 0)
+                    res_att[idx] = (
+                        (q_mat * k_mat).sum(dim=-1)
+                        * self.relation_pri[relation_type]
+                        / sqrt_dkt
+                    )
+                    v_mat = v_linear(source_node_vec).view(-1, self.n_heads, dks)
+                    msg_store[edge_rank[idx]] = torch.bmm(
+                        v_mat.transpose(1, 0), self.relation_msg[relation_type]
+                    ).transpose(1, 0)
+
+        self.att = softmax(res_att, target)
+        att = self.att.unsqueeze(-1)
+        aggr_h = msg_h.new_zeros(h_inp.size(0), self.n_heads, self.d_kh)
+        aggr_h.index_add_(
+            0, local_index[target[target_is_h]], msg_h * att[target_is_h]
+        )
+        aggr_l = msg_l.new_zeros(l_inp.size(0), self.n_heads, self.d_kl)
+        aggr_l.index_add_(
+            0, local_index[target[~target_is_h]], msg_l * att[~target_is_h]
+        )
+        del res_att, msg_h, msg_l
+        return self.update_split(
+            aggr_h.view(-1, self.h_dim),
+            aggr_l.view(-1, self.l_dim),
+            h_inp,
+            l_inp,
+            node_type,
+        )
+
+    def update_split(self, aggr_h, aggr_l, h_inp, l_inp, node_type):
+        """
+            Step 3 of forward_split, on the per-type stores.
+        """
+        is_h = self.is_h_type(node_type)
+        h_res = torch.zeros_like(h_inp)
+        l_res = torch.zeros_like(l_inp)
+        for target_type in range(self.num_types):
+            if target_type in self.h_types:
+                aggr_out, node_inp, res = aggr_h, h_inp, h_res
+                idx = node_type[is_h] == int(target_type)
+            else:
+                aggr_out, node_inp, res = aggr_l, l_inp, l_res
+                idx = node_type[~is_h] == int(target_type)
+            if idx.sum() == 0:
+                continue
+            trans_out = self.drop(self.a_linears[target_type](F.gelu(aggr_out[idx])))
+            alpha = torch.sigmoid(self.skip[target_type])
+            out = trans_out * alpha + node_inp[idx] * (1 - alpha)
+            if self.use_norm:
+                out = self.norms[target_type](out)
+            res[idx] = out
+        return h_res, l_res
+
+    def is_h_type(self, node_type):
+        is_h = torch.zeros_like(node_type, dtype=torch.bool)
+        for t in self.h_types:
+            is_h |= node_type == t
+        return is_h
+
     def update(self, aggr_out, node_inp, node_type):
         """
             Step 3: Target-specific Aggregation
@@ -450,6 +776,7 @@ class DenseHGTConv(MessagePassing):
         dropout=0.2,
         use_norm=True,
         use_RTE=True,
+        fused=False,
         **kwargs
     ):
         super(DenseHGTConv, self).__init__(node_dim=0, aggr="add", **kwargs)
@@ -464,6 +791,7 @@ class DenseHGTConv(MessagePassing):
         self.sqrt_dk = math.sqrt(self.d_k)
         self.use_norm = use_norm
         self.use_RTE = use_RTE
+        self.fused = fused
         self.att = None
 
         self.k_linears = nn.ModuleList()
@@ -502,6 +830,18 @@ class DenseHGTConv(MessagePassing):
         self.out_norm = nn.LayerNorm(out_dim)
 
     def forward(self, node_inp, node_type, edge_index, edge_type, edge_time):
+        if self.fused:
+            aggr_out = fused_hgt_propagate(
+                self,
+                node_inp,
+                node_type,
+                edge_index,
+                edge_type,
+                edge_time,
+                [(self.in_dim, self.d_k)] * self.num_types,
+                [self.emb if self.use_RTE else None] * self.num_types,
+            )
+            return self.update(aggr_out, node_inp, node_type)
         return self.propagate(
             edge_index,
             node_inp=node_inp,
@@ -653,6 +993,7 @@ class GeneralConv(nn.Module):
         dropout,
         use_norm=True,
         use_RTE=True,
+        fused=False,
     ):
         super(GeneralConv, self).__init__()
         self.conv_name = conv_name
@@ -666,6 +1007,7 @@ class GeneralConv(nn.Module):
                 dropout,
                 use_norm,
                 use_RTE,
+                fused=fused,
             )
         elif self.conv_name == "dense_hgt":
             self.base_conv = DenseHGTConv(
@@ -677,6 +1019,7 @@ class GeneralConv(nn.Module):
                 dropout,
                 use_norm,
                 use_RTE,
+                fused=fused,
             )
         elif self.conv_name == "gcn":
             self.base_conv = GCNConv(in_hid, out_hid)
@@ -8,9 +8,25 @@ from torch import nn
 from transformers import get_linear_schedule_with_warmup, AdamW
 import json
 from model import VIBERC, CasualVIBERC, RobertaClassifier, CasualRobertaClassifier
+from utils.metrics import MetricsSink, SimilarityWriter, ConfusionMatrix
+from utils.checkpoint import CheckpointManager, EarlyStopping, load_model_state
+from utils.distributed import (
+    init_distributed,
+    is_distributed,
+    is_main_process,
+    barrier,
+    all_reduce_sum,
+    DistributedBatchSampler,
+)
 from utils import (
     ErcTextDataset,
     RECCONTextDataset,
+    ErcCollator,
+    DialogueCollator,
+    RecconCollator,
+    LengthBucketBatchSampler,
+    DialogueBatchSampler,
+    batch_to_device,
     get_num_classes,
     replace_for_robust_eval,
 )
@@ -31,356 +47,387 @@ from sklearn.metrics import (
 )
 import torch.cuda.amp.grad_scaler as grad_scaler
 import torch.cuda.amp.autocast_mode as autocast_mode
+from torch.nn.parallel import DistributedDataParallel
 
 
-def train_or_eval(
-    epoch,
-    model,
-    optimizer,
-    scheduler,
-    loss_function,
-    mode,
-    data,
-    batch_size,
-    cuda,
-    alpha,
-    beta,
-    scaler,
-    kl_weights_dict,
-):
+def amp_autocast(cuda):
+    """Autocast a forward pass when --AMP is set.
 
-    random.shuffle(data)
-    if mode == "train":
-        model.train()
-    else:
-        model.eval()
-    predicts = []
-    ground_truth = []
-    loss_list = []
-    latent_param_dict = {}
-    for item in kl_weights_dict.keys():
-        latent_param_dict[item] = []
-    label_records = []
-    f_cos_simi = []
-    b_cos_simi = []
-    for i in range(0, len(data), batch_size):
-        if mode == "train":
-            optimizer.zero_grad()
-        bs_data = data[i : min(i + batch_size, len(data))]
-        input_data = pad_sequence(
-            [torch.LongTensor(item["input_ids"]) for item in bs_data],
-            batch_first=True,
-            padding_value=1,
-        )
-        masks = pad_sequence(
-            [torch.LongTensor(item["attention_mask"]) for item in bs_data],
-            batch_first=True,
-            padding_value=0,
-        )
+    The GPU runs in float16, with the loss scaled by the GradScaler; the CPU
+    runs in bfloat16, which needs no loss scaling.
+    """
+    if cuda:
+        return autocast_mode.autocast(enabled=args["AMP"])
+    return torch.cpu.amp.autocast(enabled=args["AMP"], dtype=torch.bfloat16)
 
-        """input_data = []
-        masks = []
-        for item in bs_data:
-            input_data += item['input_ids']
-            masks += item['attention_mask']
-        input_data = pad_sequence([torch.LongTensor(item) for item in input_data], batch_first=True,
-                                  padding_value=1)
-        masks = pad_sequence([torch.LongTensor(item) for item in masks], batch_first=True,
-                             padding_value=0)"""
-
-        utt_pos_masks = []
-        for i in range(len(bs_data[0]["pos_masks"])):
-            utt_pos_masks.append(
-                pad_sequence(
-                    [torch.LongTensor(item["pos_masks"][i]) for item in bs_data],
-                    batch_first=True,
-                    padding_value=0,
-                )
-            )
-        utt_pos_masks = torch.stack(utt_pos_masks, dim=0)
 
-        comet_features = torch.stack(
-            [item["comet_features"]["feature"] for item in bs_data], dim=0
-        )
-        comet_masks = torch.stack(
-            [item["comet_features"]["mask"] for item in bs_data], dim=0
-        )
-        labels = torch.LongTensor([item["label"] for item in bs_data])
-        # comet_sent_labels = torch.LongTensor([item['comet_features']['comet_sent_labels'] for item in bs_data])
-        if cuda:
-            input_data = input_data.cuda()
-            masks = masks.cuda()
-            utt_pos_masks = utt_pos_masks.cuda()
-            labels = labels.cuda()
-
-            comet_features = comet_features.cuda()
-            comet_masks = comet_masks.cuda()
-            # comet_sent_labels = comet_sent_labels.cuda()
+def divide_gradients(optimizer, divisor):
+    for group in optimizer.param_groups:
+        for param in group["params"]:
+            if param.grad is not None:
+                param.grad.div_(divisor)
+
+
+def step_optimizer(optimizer, scheduler, scaler):
+    """Apply the accumulated gradients and advance the LR schedule.
+
+    The GradScaler skips the update when the gradients hold inf/nan, and then
+    lowers its scale; the schedule only advances on real updates. Returns
+    whether the update was applied.
+    """
+    scale = scaler.get_scale()
+    scaler.step(optimizer)
+    scaler.update()
+    if scaler.get_scale() < scale:
+        return False
+    scheduler.step()
+    return True
+
 
+def erc_forward(model, batch, loss_function, return_similarity=False):
+    """Run the model on a batch of ERC windows.
+
+    Returns the logits in float32, the loss, and the knowledge similarity
+    diagnostics when return_similarity is set.
+    """
+    with amp_autocast(args["CUDA"]):
         outputs, latent_params, f_cos, b_cos = model(
-            input_data, masks, utt_pos_masks, comet_features, comet_masks
-        )
-        f_cos_simi.append(f_cos)
-        b_cos_simi.append(b_cos)
-        # outputs = model(input_data, masks, utt_pos_masks)
-        ce_loss = loss_function(outputs, labels)
-        # utt_comet_ce_loss = loss_function(comet_utt_output.view(-1, comet_utt_output.shape[-1]), comet_sent_labels.view(-1))
-        """kl_loss = losses.compute_kl_divergence_losses(
-            model, latent_params, kl_weights_dict)['total_weighted_kl']"""
-        # loss = ce_loss + kl_loss
-        loss = ce_loss
-
-        if mode == "train":
-            loss.backward()
-            optimizer.step()
-            scheduler.step()
-
-        ground_truth += labels.cpu().numpy().tolist()
-        # ground_truth += o_labels
-        predicts += torch.argmax(outputs, dim=1).cpu().numpy().tolist()
-        # predicts += compute_predicts(outputs.cpu(), label_VAD)
-        loss_list.append(loss.item())
-        if mode == "eval":
-            for item in latent_params.keys():
-                k = torch.cat(
-                    [
-                        latent_params[item].mu.cpu().detach(),
-                        torch.exp(latent_params[item].logvar.cpu().detach()),
-                        latent_params[item].z.cpu().detach(),
-                    ],
-                    dim=-1,
-                )
-                latent_param_dict[item].append(k)
-            label_records += labels.cpu().tolist()
-
-    avg_loss = round(np.sum(loss_list) / len(loss_list), 4)
-    avg_accuracy = round(accuracy_score(ground_truth, predicts) * 100, 2)
-    weighted_f1 = round(f1_score(ground_truth, predicts, average="weighted") * 100, 2)
-    if args["DATASET"] == "DailyDialog":
-        micro_f1 = round(
-            f1_score(ground_truth, predicts, average="micro", labels=list(range(1, 7)))
-            * 100,
-            2,
+            batch["input_ids"],
+            batch["attention_mask"],
+            batch["utt_pos_spans"],
+            # The knowledge features are stored in FEATURE_DTYPE; compute in float32.
+            batch["comet_features"].float(),
+            batch["comet_masks"],
+            batch.get("window_rows"),
+            return_similarity=return_similarity,
         )
-    else:
-        micro_f1 = round(f1_score(ground_truth, predicts, average="micro") * 100, 2)
-    # micro_f1 = round(f1_score(ground_truth, predicts, average='micro', labels=list(range(1, 7))) * 100, 2)
-    macro_f1 = round(f1_score(ground_truth, predicts, average="macro") * 100, 2)
+    outputs = outputs.float()
+    """kl_loss = losses.compute_kl_divergence_losses(
+        model, latent_params, kl_weights_dict)['total_weighted_kl']"""
+    # loss = ce_loss + kl_loss
+    loss = loss_function(outputs, batch["labels"])
+    return outputs, loss, f_cos, b_cos
 
-    result_name = "result.xlsx"
-    if os.path.exists(result_name):
-        result = pd.read_excel(result_name)
-    else:
-        result = pd.DataFrame(
-            columns=[
-                "epochs",
-                "mode",
-                "avg_loss",
-                "weighted_f1",
-                "micro_f1",
-                "macro_f1",
-                "dataset",
-                "experiment",
-                "params",
-            ]
+
+def casual_forward(model, batch, loss_function):
+    """Run the model on a batch of RECCON pairs.
+
+    Returns the cause probabilities in float32 and the loss.
+    """
+    with amp_autocast(args["CUDA"]):
+        emo_outputs, cause_outputs, latent_params = model(
+            batch["input_ids"],
+            batch["attention_mask"],
+            batch["pos_masks"],
+            batch["comet_features"].float(),
         )
-    params = ",".join([key + ":" + str(value) for key, value in args.items()])
-    new_df = pd.DataFrame(
-        [
-            [
-                epoch,
-                mode,
-                avg_loss,
-                weighted_f1,
-                micro_f1,
-                macro_f1,
-                args["DATASET"],
-                args["experiment"],
-                params,
-            ]
-        ],
-        columns=[
-            "epochs",
-            "mode",
-            "avg_loss",
-            "weighted_f1",
-            "micro_f1",
-            "macro_f1",
-            "dataset",
-            "experiment",
-            "params",
-        ],
-    )
-    result = pd.concat([result, new_df], axis=0)
-    result.to_excel(result_name, index=False)
-
-    if mode == "train":
-        print(
-            "For epoch {}, train loss:{}, weighted F1 {}, micro F1 {}, macro F1 {}".format(
-                epoch, avg_loss, weighted_f1, micro_f1, macro_f1
+    # BCELoss is not autocast-safe, so the losses are computed in float32.
+    emo_outputs = emo_outputs.float()
+    cause_outputs = cause_outputs.float()
+    emo_loss = loss_function(emo_outputs, batch["emolabels"])
+    cause_loss = nn.functional.binary_cross_entropy(cause_outputs, batch["labels"])
+    loss = cause_loss + emo_loss * args["alpha"]
+    return cause_outputs, loss
+
+
+def summarize_pass(epoch, mode, confusion, total_loss, num_losses, subset=None):
+    """Sum the metric counts of a pass over all processes, and log and print them.
+
+    :param subset: The classes micro F1 and per-class F1 are reported over.
+        Defaults to all classes.
+    :return: The metrics of the pass, and the scores over `subset`.
+    """
+    confusion.matrix = all_reduce_sum(confusion.matrix, args["device"])
+    total_loss = all_reduce_sum(total_loss, args["device"])
+    num_losses = all_reduce_sum(num_losses, args["device"])
+    avg_loss = round(float(total_loss) / max(int(num_losses), 1), 4)
+    scores = confusion.compute()
+    subset_scores = scores if subset is None else confusion.compute(labels=subset)
+    results = {
+        "avg_loss": avg_loss,
+        "weighted_f1": round(scores["weighted_f1"] * 100, 2),
+        "micro_f1": round(subset_scores["micro_f1"] * 100, 2),
+        "macro_f1": round(scores["macro_f1"] * 100, 2),
+    }
+    if not is_main_process():
+        return results, subset_scores
+
+    if args["DATASET"] != "RECCON":
+        params = ",".join([key + ":" + str(value) for key, value in args.items()])
+        metrics_sink.log(
+            dict(
+                results,
+                epochs=epoch,
+                mode=mode,
+                dataset=args["DATASET"],
+                experiment=args["experiment"],
+                params=params,
             )
         )
-    if mode == "dev":
-        print(
-            "For epoch {}, dev loss:{}, weighted F1 {}, micro F1 {}, macro F1 {}".format(
-                epoch, avg_loss, weighted_f1, micro_f1, macro_f1
-            )
+    print(
+        "For epoch {}, {} loss:{}, weighted F1 {}, micro F1 {}, macro F1 {}".format(
+            epoch,
+            "test" if mode == "eval" else mode,
+            avg_loss,
+            results["weighted_f1"],
+            results["micro_f1"],
+            results["macro_f1"],
+        )
+    )
+    return results, subset_scores
+
+
+def erc_subset():
+    # DailyDialog reports micro F1 and per-class F1 without the neutral class.
+    return range(1, 7) if args["DATASET"] == "DailyDialog" else None
+
+
+def train_epoch(epoch, model, optimizer, scheduler, loss_function, loader, scaler):
+    """Train the model for one epoch over an ERC loader."""
+    model.train()
+    # Metrics are accumulated on device and read back once after the pass.
+    confusion = ConfusionMatrix(get_num_classes(args["DATASET"]), args["device"])
+    total_loss = 0.0
+    num_losses = 0
+    num_tokens = 0
+    num_padded_tokens = 0
+    # Every ACCUM_STEPS micro-batches form one optimizer step.
+    accum_steps = args["ACCUM_STEPS"]
+    num_batches = len(loader)
+    num_optimizer_steps = 0
+    for step, batch in enumerate(loader):
+        if step % accum_steps == 0:
+            optimizer.zero_grad()
+            step_samples = 0
+        sync = (step + 1) % accum_steps == 0 or step + 1 == num_batches
+        if isinstance(model, DistributedDataParallel):
+            # Only all-reduce the gradients of the last micro-batch of a step.
+            # DDP reads the flag in forward, so it is set before the forward pass.
+            model.require_backward_grad_sync = sync
+        if args["CUDA"]:
+            batch = batch_to_device(batch, args["device"])
+        labels = batch["labels"]
+        masks = batch["attention_mask"]
+        num_tokens += masks.numel()
+        num_padded_tokens += masks.numel() - masks.sum()
+
+        outputs, loss, _, _ = erc_forward(model, batch, loss_function)
+
+        # Backpropagate the summed loss of the micro-batch, and divide by the
+        # samples of the whole step below, so that micro-batches of any size
+        # add up to the mean loss of the step.
+        num_samples = (labels != -1).sum()
+        step_samples = step_samples + num_samples
+        scaler.scale(loss * num_samples).backward()
+        if sync:
+            # DDP averages the gradients over the processes.
+            step_samples = all_reduce_sum(step_samples, args["device"])
+            scaler.unscale_(optimizer)
+            divide_gradients(optimizer, step_samples / args["world_size"])
+            if step_optimizer(optimizer, scheduler, scaler):
+                num_optimizer_steps += 1
+
+        confusion.update(labels, torch.argmax(outputs, dim=1))
+        total_loss += loss.detach()
+        num_losses += 1
+
+    num_tokens = all_reduce_sum(num_tokens, args["device"])
+    num_padded_tokens = all_reduce_sum(num_padded_tokens, args["device"])
+    results, _ = summarize_pass(
+        epoch, "train", confusion, total_loss, num_losses, erc_subset()
+    )
+    if is_main_process():
+        padding_ratio = round(
+            float(num_padded_tokens) / max(int(num_tokens), 1) * 100, 2
         )
-    if mode == "test" or mode == "eval":
         print(
-            "For epoch {}, test loss:{}, weighted F1 {}, micro F1 {}, macro F1 {}".format(
-                epoch, avg_loss, weighted_f1, micro_f1, macro_f1
+            "For epoch {}, optimizer steps {}, padding ratio {}%".format(
+                epoch, num_optimizer_steps, padding_ratio
             )
         )
-        f_cos_simi = torch.cat(f_cos_simi, dim=0).transpose(1, 0).tolist()
-        b_cos_simi = torch.cat(b_cos_simi, dim=0).transpose(1, 0).tolist()
-        rep_similarity_path = os.path.join("./rep_similarity", args["DATASET"])
-        if not os.path.exists(rep_similarity_path):
-            os.makedirs(rep_similarity_path)
-        metric = {
-            "weighted_f1": weighted_f1,
-            "micro_f1": micro_f1,
-            "macro_f1": macro_f1,
-        }
-        pickle.dump(
-            metric, open("{}/metric_{}.pkl".format(rep_similarity_path, epoch), "wb+")
+    return results
+
+
+def casual_train_epoch(
+    epoch, model, optimizer, scheduler, loss_function, loader, scaler
+):
+    """Train the model for one epoch over a RECCON loader."""
+    model.train()
+    # Metrics are accumulated on device and read back once after the pass.
+    confusion = ConfusionMatrix(2, args["device"])
+    total_loss = 0.0
+    num_losses = 0
+    for batch in loader:
+        optimizer.zero_grad()
+        if args["CUDA"]:
+            batch = batch_to_device(batch, args["device"])
+        cause_outputs, loss = casual_forward(model, batch, loss_function)
+        scaler.scale(loss).backward()
+        step_optimizer(optimizer, scheduler, scaler)
+
+        confusion.update(batch["labels"], torch.gt(cause_outputs, 0.5))
+        total_loss += loss.detach()
+        num_losses += 1
+    results, _ = summarize_pass(epoch, "train", confusion, total_loss, num_losses)
+    return results
+
+
+def evaluate(epoch, model, loss_function, mode, loader):
+    """Run a dev, test or eval pass of the model under inference mode.
+
+    No autograd graph is recorded, which is why the eval loaders can use the
+    larger EVAL_BATCH_SIZE. Returns the metrics of the pass.
+    """
+    if args["DATASET"] == "RECCON":
+        return casual_evaluate(epoch, model, loss_function, mode, loader)
+    model.eval()
+    confusion = ConfusionMatrix(get_num_classes(args["DATASET"]), args["device"])
+    total_loss = 0.0
+    num_losses = 0
+    test = mode == "test" or mode == "eval"
+    rep_similarity_path = os.path.join("./rep_similarity", args["DATASET"])
+    # The knowledge similarity diagnostics are only computed in analysis mode.
+    analyze = args["rep_similarity"] and test
+    if analyze:
+        os.makedirs(rep_similarity_path, exist_ok=True)
+        f_cos_writer = SimilarityWriter(
+            "{}/f_{}.npy".format(rep_similarity_path, epoch), len(loader.dataset)
         )
-        pickle.dump(
-            f_cos_simi, open("{}/f_{}.pkl".format(rep_similarity_path, epoch), "wb+")
+        b_cos_writer = SimilarityWriter(
+            "{}/b_{}.npy".format(rep_similarity_path, epoch), len(loader.dataset)
         )
-        pickle.dump(
-            b_cos_simi, open("{}/b_{}.pkl".format(rep_similarity_path, epoch), "wb+")
+    with torch.inference_mode():
+        for batch in loader:
+            if args["CUDA"]:
+                batch = batch_to_device(batch, args["device"])
+            outputs, loss, f_cos, b_cos = erc_forward(
+                model, batch, loss_function, return_similarity=analyze
+            )
+            if analyze:
+                f_cos_writer.write(f_cos)
+                b_cos_writer.write(b_cos)
+            confusion.update(batch["labels"], torch.argmax(outputs, dim=1))
+            total_loss += loss
+            num_losses += 1
+
+    results, subset_scores = summarize_pass(
+        epoch, mode, confusion, total_loss, num_losses, erc_subset()
+    )
+    if not is_main_process() or not test:
+        return results
+    if analyze:
+        f_cos_writer.close()
+        b_cos_writer.close()
+    # rep_similarity/test.ipynb reads the test scores of every run, with or
+    # without the similarity diagnostics.
+    os.makedirs(rep_similarity_path, exist_ok=True)
+    metric = {
+        "weighted_f1": results["weighted_f1"],
+        "micro_f1": results["micro_f1"],
+        "macro_f1": results["macro_f1"],
+    }
+    with open("{}/metric_{}.pkl".format(rep_similarity_path, epoch), "wb+") as f:
+        pickle.dump(metric, f)
+    print(subset_scores["per_class_f1"])
+    return results
+
+
+def casual_evaluate(epoch, model, loss_function, mode, loader):
+    """The RECCON counterpart of evaluate."""
+    model.eval()
+    confusion = ConfusionMatrix(2, args["device"])
+    total_loss = 0.0
+    num_losses = 0
+    with torch.inference_mode():
+        for batch in loader:
+            if args["CUDA"]:
+                batch = batch_to_device(batch, args["device"])
+            cause_outputs, loss = casual_forward(model, batch, loss_function)
+            confusion.update(batch["labels"], torch.gt(cause_outputs, 0.5))
+            total_loss += loss
+            num_losses += 1
+    results, scores = summarize_pass(epoch, mode, confusion, total_loss, num_losses)
+    if is_main_process() and (mode == "test" or mode == "eval"):
+        print(scores["per_class_f1"])
+    return results
+
+
+def make_loader(dataset, collate_fn, batch_size, shuffle, batch_sampler=None):
+    """Build a DataLoader that assembles the next batches while a step runs.
+
+    Batches are pinned when training on the GPU, so that they can be copied
+    with non_blocking transfers. Under torchrun, every process loads its own
+    share of the batches.
+    """
+    if batch_sampler is None and args["length_bucketing"] and batch_size > 1:
+        batch_sampler = LengthBucketBatchSampler(
+            [len(item["input_ids"]) for item in dataset.inputs_],
+            batch_size,
+            bucket_size=args["bucket_size"],
+            shuffle=shuffle,
         )
-        if args["DATASET"] == "DailyDialog":
-            print(
-                f1_score(ground_truth, predicts, average=None, labels=list(range(1, 7)))
+    if is_distributed():
+        if batch_sampler is None:
+            if shuffle:
+                sampler = torch.utils.data.RandomSampler(dataset)
+            else:
+                sampler = torch.utils.data.SequentialSampler(dataset)
+            batch_sampler = torch.utils.data.BatchSampler(
+                sampler, batch_size, drop_last=False
             )
-        else:
-            print(f1_score(ground_truth, predicts, average=None))
-
-
-def casual_train_or_eval(
-    epoch,
-    model,
-    optimizer,
-    scheduler,
-    loss_function,
-    mode,
-    data,
-    batch_size,
-    cuda,
-    alpha,
-    beta,
-    scaler,
-    kl_weights_dict,
-):
-    random.shuffle(data)
-    if mode == "train":
-        model.train()
-    else:
-        model.eval()
-    predicts = []
-    ground_truth = []
-    loss_list = []
-    latent_param_dict = {}
-    bceloss = nn.BCELoss()
-    for item in kl_weights_dict.keys():
-        latent_param_dict[item] = []
-    label_records = []
-    for i in range(0, len(data), batch_size):
-        if mode == "train":
-            optimizer.zero_grad()
-        bs_data = data[i]
-        # input_data = pad_sequence([torch.LongTensor(item['input_ids']) for item in bs_data], batch_first=True, padding_value=1)
-        # masks = pad_sequence([torch.LongTensor(item['attention_mask']) for item in bs_data], batch_first=True, padding_value=0)
-        input_data = torch.LongTensor(bs_data["input_ids"])
-        masks = torch.LongTensor(bs_data["attention_mask"])
-
-        """input_data = []
-        masks = []
-        for item in bs_data:
-            input_data += item['input_ids']
-            masks += item['attention_mask']
-        input_data = pad_sequence([torch.LongTensor(item) for item in input_data], batch_first=True,
-                                  padding_value=1)
-        masks = pad_sequence([torch.LongTensor(item) for item in masks], batch_first=True,
-                             padding_value=0)"""
-
-        pos_masks = bs_data["pos_masks"]
-        comet_features = torch.stack(
-            [torch.FloatTensor(item) for item in bs_data["comet_features"]], dim=0
+        # Only the shuffled train loaders need the same number of steps on
+        # every process.
+        batch_sampler = DistributedBatchSampler(
+            batch_sampler,
+            args["world_size"],
+            args["rank"],
+            seed=args["SEED"],
+            pad=shuffle,
         )
-        labels = torch.FloatTensor(bs_data["label"])
-        emolabels = torch.LongTensor(bs_data["emolabel"])
-        if cuda:
-            input_data = input_data.cuda()
-            masks = masks.cuda()
-            pos_masks = pos_masks.cuda()
-            labels = labels.cuda()
+    if batch_sampler is not None:
+        batching = {"batch_sampler": batch_sampler}
+    else:
+        batching = {"batch_size": batch_size, "shuffle": shuffle}
+    return torch.utils.data.DataLoader(
+        dataset,
+        **batching,
+        collate_fn=collate_fn,
+        num_workers=args["num_workers"],
+        pin_memory=args["CUDA"],
+        persistent_workers=args["num_workers"] > 0,
+    )
 
-            comet_features = comet_features.cuda()
-            emolabels = emolabels.cuda()
 
-        emo_outputs, cause_outputs, latent_params = model(
-            input_data, masks, pos_masks, comet_features
-        )
-        # emo_outputs, cause_outputs = model(input_data, masks, pos_masks)
-        emo_loss = loss_function(emo_outputs, emolabels)
-        cause_loss = bceloss(cause_outputs, labels)
-        # utt_comet_ce_loss = loss_function(comet_utt_output.view(-1, comet_utt_output.shape[-1]), comet_sent_labels.view(-1))
-        """kl_loss = losses.compute_kl_divergence_losses(
-            model, latent_params, kl_weights_dict)['total_weighted_kl']"""
-        loss = cause_loss + emo_loss * alpha
-        # loss = cause_loss + alpha*emo_loss
-
-        if mode == "train":
-            loss.backward()
-            optimizer.step()
-            scheduler.step()
-
-        ground_truth += labels.cpu().numpy().tolist()
-        # ground_truth += o_labels
-        predicts += torch.gt(cause_outputs, 0.5).long().cpu().numpy().tolist()
-        # predicts += compute_predicts(outputs.cpu(), label_VAD)
-        loss_list.append(loss.item())
-        if mode == "eval":
-            for item in latent_params.keys():
-                k = torch.cat(
-                    [
-                        latent_params[item].mu.cpu().detach(),
-                        torch.exp(latent_params[item].logvar.cpu().detach()),
-                        latent_params[item].z.cpu().detach(),
-                    ],
-                    dim=-1,
+def make_erc_loader(dataset, batch_size, shuffle):
+    """Build the DataLoader of an ErcTextDataset split.
+
+    With --share_dialogue_encoding, a batch holds every target of batch_size
+    dialogues, and each dialogue is encoded once for all of them.
+    """
+    if args["share_dialogue_encoding"]:
+        # The shared encoding sees the whole dialogue, so it only matches the
+        # per-target contexts when these reach every other utterance.
+        longest = int(np.diff(dataset.chunk_bank.dialogue_starts).max(initial=0))
+        window = min(args["num_past_utterances"], args["num_future_utterances"])
+        if window < longest - 1:
+            raise ValueError(
+                "--share_dialogue_encoding needs num_past_utterances and "
+                "num_future_utterances of at least {} for {} {}".format(
+                    longest - 1, dataset.DATASET, dataset.SPLIT
                 )
-                latent_param_dict[item].append(k)
-            label_records += labels.cpu().tolist()
-
-    avg_loss = round(np.sum(loss_list) / len(loss_list), 4)
-    avg_accuracy = round(accuracy_score(ground_truth, predicts) * 100, 2)
-    weighted_f1 = round(f1_score(ground_truth, predicts, average="weighted") * 100, 2)
-    micro_f1 = round(f1_score(ground_truth, predicts, average="micro") * 100, 2)
-    # micro_f1 = round(f1_score(ground_truth, predicts, average='micro', labels=list(range(1, 7))) * 100, 2)
-    macro_f1 = round(f1_score(ground_truth, predicts, average="macro") * 100, 2)
-    if mode == "train":
-        print(
-            "For epoch {}, train loss:{}, weighted F1 {}, micro F1 {}, macro F1 {}".format(
-                epoch, avg_loss, weighted_f1, micro_f1, macro_f1
             )
+        return make_loader(
+            dataset,
+            DialogueCollator(dataset.comet_bank, dataset.chunk_bank),
+            batch_size,
+            shuffle,
+            batch_sampler=DialogueBatchSampler(
+                [item["comet_features"]["dialogue"] for item in dataset.inputs_],
+                batch_size,
+                shuffle=shuffle,
+            ),
         )
-    if mode == "dev":
-        print(
-            "For epoch {}, dev loss:{}, weighted F1 {}, micro F1 {}, macro F1 {}".format(
-                epoch, avg_loss, weighted_f1, micro_f1, macro_f1
-            )
-        )
-    if mode == "test" or mode == "eval":
-        print(
-            "For epoch {}, test loss:{}, weighted F1 {}, micro F1 {}, macro F1 {}".format(
-                epoch, avg_loss, weighted_f1, micro_f1, macro_f1
-            )
-        )
-        print(f1_score(ground_truth, predicts, average=None))
+    return make_loader(dataset, ErcCollator(dataset.comet_bank), batch_size, shuffle)
 
 
 def main(
@@ -403,6 +450,15 @@ def main(
     # CUDA = False
     ROOT_DIR = args["ROOT_DIR"]
     NUM_CLASS = get_num_classes(DATASET)
+    # Without autograd, evaluation fits much larger batches than training.
+    EVAL_BATCH_SIZE = args["EVAL_BATCH_SIZE"] or 4 * BATCH_SIZE
+    if DATASET != "RECCON" and BATCH_SIZE % args["ACCUM_STEPS"] != 0:
+        raise ValueError(
+            f"BATCH_SIZE {BATCH_SIZE} is not divisible by ACCUM_STEPS "
+            f"{args['ACCUM_STEPS']}"
+        )
+    # Each optimizer step accumulates the gradients of ACCUM_STEPS micro-batches.
+    MICRO_BATCH_SIZE = BATCH_SIZE // args["ACCUM_STEPS"]
     lr = float(LR)
     # label_VAD = get_label_VAD(DATASET)
 
@@ -414,6 +470,8 @@ def main(
             model_checkpoint=model_checkpoint,
             ROOT_DIR=ROOT_DIR,
             SEED=SEED,
+            FEATURE_DTYPE=args["FEATURE_DTYPE"],
+            num_preprocess_workers=args["num_preprocess_workers"],
         )
         ds_val = RECCONTextDataset(
             DATASET=DATASET,
@@ -422,6 +480,8 @@ def main(
             model_checkpoint=model_checkpoint,
             ROOT_DIR=ROOT_DIR,
             SEED=SEED,
+            FEATURE_DTYPE=args["FEATURE_DTYPE"],
+            num_preprocess_workers=args["num_preprocess_workers"],
         )
         ds_test = RECCONTextDataset(
             DATASET=DATASET,
@@ -430,6 +490,8 @@ def main(
             model_checkpoint=model_checkpoint,
             ROOT_DIR=ROOT_DIR,
             SEED=SEED,
+            FEATURE_DTYPE=args["FEATURE_DTYPE"],
+            num_preprocess_workers=args["num_preprocess_workers"],
         )
         model = CasualVIBERC(args, NUM_CLASS)
         # model = CasualRobertaClassifier(args, NUM_CLASS)
@@ -445,6 +507,11 @@ def main(
             ROOT_DIR=ROOT_DIR,
             SEED=SEED,
             COMET_WIN_SIZE=COMET_WIN_SIZE,
+            FEATURE_DTYPE=args["FEATURE_DTYPE"],
+            CHUNK_STRIDE=args["CHUNK_STRIDE"],
+            CACHE_DIR=args["CACHE_DIR"],
+            tokenize_once=args["tokenize_once"],
+            num_preprocess_workers=args["num_preprocess_workers"],
         )
         ds_val = ErcTextDataset(
             DATASET=DATASET,
@@ -456,6 +523,11 @@ def main(
             ROOT_DIR=ROOT_DIR,
             SEED=SEED,
             COMET_WIN_SIZE=COMET_WIN_SIZE,
+            FEATURE_DTYPE=args["FEATURE_DTYPE"],
+            CHUNK_STRIDE=args["CHUNK_STRIDE"],
+            CACHE_DIR=args["CACHE_DIR"],
+            tokenize_once=args["tokenize_once"],
+            num_preprocess_workers=args["num_preprocess_workers"],
         )
         ds_test = ErcTextDataset(
             DATASET=DATASET,
@@ -467,18 +539,32 @@ def main(
             ROOT_DIR=ROOT_DIR,
             SEED=SEED,
             COMET_WIN_SIZE=COMET_WIN_SIZE,
+            FEATURE_DTYPE=args["FEATURE_DTYPE"],
+            CHUNK_STRIDE=args["CHUNK_STRIDE"],
+            CACHE_DIR=args["CACHE_DIR"],
+            tokenize_once=args["tokenize_once"],
+            num_preprocess_workers=args["num_preprocess_workers"],
         )
         model = VIBERC(args, NUM_CLASS)
         # model = RobertaClassifier(args, NUM_CLASS)
+        if args["compile"]:
+            model.enable_compile()
 
-    tr_data = ds_train.inputs_
-    dev_data = ds_val.inputs_
-    test_data = ds_test.inputs_
     if args["robust_rate"] != 0.0:
-        tr_data = replace_for_robust_eval(tr_data, args["robust_rate"], NUM_CLASS)
+        replace_for_robust_eval(ds_train.inputs_, args["robust_rate"], NUM_CLASS)
+
+    if DATASET == "RECCON":
+        # CasualVIBERC encodes one dialogue per step.
+        train_loader = make_loader(ds_train, RecconCollator(), 1, shuffle=True)
+        dev_loader = make_loader(ds_val, RecconCollator(), 1, shuffle=False)
+        test_loader = make_loader(ds_test, RecconCollator(), 1, shuffle=False)
+    else:
+        train_loader = make_erc_loader(ds_train, MICRO_BATCH_SIZE, shuffle=True)
+        dev_loader = make_erc_loader(ds_val, EVAL_BATCH_SIZE, shuffle=False)
+        test_loader = make_erc_loader(ds_test, EVAL_BATCH_SIZE, shuffle=False)
 
     if args["mode"] != "train":
-        model.load_state_dict(torch.load(args["model_load_path"]))
+        model.load_state_dict(load_model_state(args["model_load_path"]))
         model.eval()
 
     # kl_weights_dict = {'utt': args['utt_kl_weight'], 'comet_utt': args['comet_utt_kl_weight']}
@@ -497,154 +583,107 @@ def main(
         optimizer = AdamW(model.parameters(), lr=lr, weight_decay=WEIGHT_DECAY)
 
         """Use linear scheduler."""
-        s_total_steps = float(NUM_TRAIN_EPOCHS * len(ds_train.inputs_)) / BATCH_SIZE
+        # Count the optimizer steps the training loop actually takes.
+        if DATASET == "RECCON":
+            steps_per_epoch = len(train_loader)
+        else:
+            steps_per_epoch = math.ceil(len(train_loader) / args["ACCUM_STEPS"])
+        s_total_steps = float(NUM_TRAIN_EPOCHS * steps_per_epoch)
         scheduler = get_linear_schedule_with_warmup(
             optimizer, int(s_total_steps * WARMUP_RATIO), math.ceil(s_total_steps)
         )
         # total_steps = math.ceil(float(args['NUM_TRAIN_EPOCHS'] * len(ds_train.inputs_)) / BATCH_SIZE)
 
         """Due to the limitation of computational resources, we use mixed floating point precision."""
-        scaler = grad_scaler.GradScaler()
+        scaler = grad_scaler.GradScaler(enabled=args["AMP"] and CUDA)
         # loss_function = nn.MSELoss()
         # loss_function = EMDLoss(args, label_type='single', label_VAD=label_VAD)
 
-        for n in range(NUM_TRAIN_EPOCHS):
+        checkpoints = CheckpointManager(
+            args["model_save_dir"], args["keep_top_k"], resume=args["resume"]
+        )
+        if not args["resume"] and is_main_process():
+            checkpoints.clear()
+        # No process reads the index before the stale one is gone.
+        barrier()
+        early_stopping = EarlyStopping(args["patience"])
+        start_epoch = 0
+        if args["resume"]:
+            state = checkpoints.load_last(model, optimizer, scheduler, scaler)
+            if state is not None:
+                start_epoch = state["epoch"] + 1
+                early_stopping = EarlyStopping(args["patience"], **state["extra"])
+        # Models are selected by the metric the dataset is reported with.
+        dev_metric = "micro_f1" if DATASET == "DailyDialog" else "weighted_f1"
+
+        # Training steps go through the DDP wrapper, which all-reduces the
+        # gradients; evaluation and checkpoints use the bare model.
+        train_model = model
+        if is_distributed():
+            train_model = DistributedDataParallel(
+                model,
+                device_ids=[args["local_rank"]] if CUDA else None,
+                find_unused_parameters=True,
+            )
+
+        for n in range(start_epoch, NUM_TRAIN_EPOCHS):
+            if isinstance(train_loader.batch_sampler, DistributedBatchSampler):
+                train_loader.batch_sampler.set_epoch(n)
             # steps = n * math.ceil(float(len(tr_data)) / BATCH_SIZE)
-            if DATASET == "RECCON":
-                casual_train_or_eval(
-                    n,
-                    model,
-                    optimizer,
-                    scheduler,
-                    loss_function,
-                    "train",
-                    tr_data,
-                    BATCH_SIZE,
-                    CUDA,
-                    args["alpha"],
-                    args["beta"],
-                    scaler,
-                    kl_weights_dict,
-                )
-                casual_train_or_eval(
-                    n,
-                    model,
-                    optimizer,
-                    scheduler,
-                    loss_function,
-                    "dev",
-                    dev_data,
-                    BATCH_SIZE,
-                    CUDA,
-                    args["alpha"],
-                    args["beta"],
-                    scaler,
-                    kl_weights_dict,
-                )
-                casual_train_or_eval(
-                    n,
-                    model,
-                    optimizer,
-                    scheduler,
-                    loss_function,
-                    "test",
-                    test_data,
-                    BATCH_SIZE,
-                    CUDA,
-                    args["alpha"],
-                    args["beta"],
-                    scaler,
-                    kl_weights_dict,
-                )
-                torch.save(
-                    model.state_dict(),
-                    args["model_save_dir"] + "/model_state_dict_" + str(n) + ".pth",
-                )
-                print("-------------------------------")
-            else:
-                train_or_eval(
-                    n,
-                    model,
-                    optimizer,
-                    scheduler,
-                    loss_function,
-                    "train",
-                    tr_data,
-                    BATCH_SIZE,
-                    CUDA,
-                    args["alpha"],
-                    args["beta"],
-                    scaler,
-                    kl_weights_dict,
-                )
-                train_or_eval(
-                    n,
-                    model,
-                    optimizer,
-                    scheduler,
-                    loss_function,
-                    "dev",
-                    dev_data,
-                    BATCH_SIZE,
-                    CUDA,
-                    args["alpha"],
-                    args["beta"],
-                    scaler,
-                    kl_weights_dict,
-                )
-                train_or_eval(
+            run_epoch = casual_train_epoch if DATASET == "RECCON" else train_epoch
+            run_epoch(
+                n,
+                train_model,
+                optimizer,
+                scheduler,
+                loss_function,
+                train_loader,
+                scaler,
+            )
+            dev_scores = evaluate(n, model, loss_function, "dev", dev_loader)
+            early_stopping.step(dev_scores[dev_metric])
+            if is_main_process() and hasattr(model, "edge_cache"):
+                # The counters cover the train and dev passes of this epoch.
+                print(model.edge_cache.summary())
+                model.edge_cache.reset_stats()
+            if is_main_process():
+                checkpoints.save(
                     n,
+                    dev_scores[dev_metric],
                     model,
                     optimizer,
                     scheduler,
-                    loss_function,
-                    "test",
-                    test_data,
-                    BATCH_SIZE,
-                    CUDA,
-                    args["alpha"],
-                    args["beta"],
                     scaler,
-                    kl_weights_dict,
-                )
-                torch.save(
-                    model.state_dict(),
-                    args["model_save_dir"] + "/model_state_dict_" + str(n) + ".pth",
+                    **early_stopping.state_dict(),
                 )
+            if is_main_process():
                 print("-------------------------------")
-    else:
-        if DATASET == "RECCON":
-            casual_train_or_eval(
-                None,
-                model,
-                None,
-                None,
-                loss_function,
-                "eval",
-                test_data,
-                BATCH_SIZE,
-                CUDA,
-                args["alpha"],
-                args["beta"],
-                None,
-                kl_weights_dict,
+            # The dev metrics are all-reduced, so every process stops together.
+            if early_stopping.should_stop:
+                if is_main_process():
+                    print(
+                        "Early stopping after epoch {}: no dev improvement in {} "
+                        "epochs".format(n, early_stopping.num_bad_epochs)
+                    )
+                break
+
+        # The test set is only evaluated once, with the best checkpoint on dev.
+        if is_main_process():
+            checkpoints.close()
+        barrier()
+        best = checkpoints.best()
+        if best is None:
+            logging.warning("no checkpoint was saved, skipping the test pass")
+        elif best["epoch"] not in range(NUM_TRAIN_EPOCHS):
+            raise RuntimeError(
+                "the best checkpoint {} is from epoch {}, outside the {} epochs of "
+                "this run".format(best["path"], best["epoch"], NUM_TRAIN_EPOCHS)
             )
         else:
-            train_or_eval(
-                None,
-                model,
-                None,
-                None,
-                loss_function,
-                "eval",
-                test_data,
-                BATCH_SIZE,
-                CUDA,
-                args["alpha"],
-                args["beta"],
-                None,
-                kl_weights_dict,
-            )
+            model.load_state_dict(load_model_state(best["path"]))
+            evaluate(best["epoch"], model, loss_function, "test", test_loader)
+    else:
+        evaluate(None, model, loss_function, "eval", test_loader)
 
 
 if __name__ == "__main__":
@@ -658,6 +697,19 @@ if __name__ == "__main__":
     parser.add_argument("--num_past_utterances", type=int, default=1000)
     parser.add_argument("--num_future_utterances", type=int, default=1000)
     parser.add_argument("--BATCH_SIZE", type=int, default=4)
+    parser.add_argument(
+        "--EVAL_BATCH_SIZE",
+        type=int,
+        default=None,
+        help="Batch size of the dev and test passes. Defaults to 4 * BATCH_SIZE.",
+    )
+    parser.add_argument(
+        "--ACCUM_STEPS",
+        type=int,
+        default=1,
+        help="Split each ERC training batch into this many micro-batches and "
+        "accumulate their gradients.",
+    )
     parser.add_argument("--LR", type=float, default=1e-5)
     parser.add_argument("--HP_ONLY_UPTO", type=int, default=10)
     parser.add_argument("--NUM_TRAIN_EPOCHS", type=int, default=10)
@@ -726,18 +778,149 @@ if __name__ == "__main__":
     parser.add_argument(
         "--ROOT_DIR", default="./comet_enhanced_data", type=str, help="The HGT type."
     )
+    parser.add_argument(
+        "--CACHE_DIR",
+        default="./dataset_cache",
+        type=str,
+        help="Cache the preprocessed datasets here. Pass an empty string to disable.",
+    )
+    parser.add_argument(
+        "--tokenize_once",
+        action="store_true",
+        help="Tokenize each utterance once per dialogue when building contexts.",
+    )
+    parser.add_argument(
+        "--num_preprocess_workers",
+        default=1,
+        type=int,
+        help="Number of processes used to build the datasets.",
+    )
+    parser.add_argument(
+        "--FEATURE_DTYPE",
+        default="float32",
+        choices=["float32", "float16", "bfloat16"],
+        help="The dtype the knowledge features are stored in between batches.",
+    )
+    parser.add_argument(
+        "--length_bucketing",
+        action="store_true",
+        help="Batch ERC samples of similar context length to reduce padding.",
+    )
+    parser.add_argument(
+        "--bucket_size",
+        default=100,
+        type=int,
+        help="Number of batches sorted together by the length bucketing sampler.",
+    )
+    parser.add_argument(
+        "--share_dialogue_encoding",
+        action="store_true",
+        help="Encode each dialogue once per batch and build every target window "
+        "from it. BATCH_SIZE then counts dialogues. The past and future "
+        "utterances must cover the longest dialogue.",
+    )
+    parser.add_argument(
+        "--CHUNK_STRIDE",
+        default=0,
+        type=int,
+        help="With --share_dialogue_encoding, encode long dialogues as overlapping "
+        "chunks that start every CHUNK_STRIDE tokens. 0 cuts the chunks at "
+        "utterance boundaries instead.",
+    )
+    parser.add_argument(
+        "--AMP",
+        action="store_true",
+        help="Train and evaluate with mixed precision.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        default=2,
+        type=int,
+        help="Number of DataLoader processes that assemble batches ahead of compute.",
+    )
+    parser.add_argument(
+        "--rep_similarity",
+        action="store_true",
+        help="Analysis mode: stream the knowledge similarity diagnostics of every "
+        "test pass to ./rep_similarity.",
+    )
+    parser.add_argument(
+        "--RESULTS_PATH",
+        default="results.jsonl",
+        type=str,
+        help="Append the metrics of every pass here. Export them to a spreadsheet "
+        "with python -m utils.metrics.",
+    )
+    parser.add_argument(
+        "--keep_top_k",
+        default=1,
+        type=int,
+        help="Keep the checkpoints of the k epochs with the best dev score, "
+        "besides the latest one.",
+    )
+    parser.add_argument(
+        "--patience",
+        default=5,
+        type=int,
+        help="Stop training after this many epochs without a better dev weighted "
+        "F1 (micro F1 on DailyDialog). 0 trains for NUM_TRAIN_EPOCHS.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue training from the latest checkpoint in model_save_dir. "
+        "Without it, a run first deletes the checkpoints left there.",
+    )
+    parser.add_argument(
+        "--compact_graph",
+        action="store_true",
+        help="Only create graph nodes for the unmasked window slots of VIBERC.",
+    )
+    parser.add_argument(
+        "--split_nodes",
+        action="store_true",
+        help="Store the utterance and the COMET-sized graph nodes of the "
+        "multidim_hgt GNN in separate tensors instead of zero-padding them.",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Compile the pooling, GNN and classifier of VIBERC with torch.compile "
+        "(torch >= 2.0).",
+    )
+    parser.add_argument(
+        "--fused_hgt",
+        action="store_true",
+        help="Compute the HGT attention and messages grouped by node type and "
+        "relation instead of per <source type, relation, target type> mask.",
+    )
     parser.add_argument("--experiment", default=1, type=int, help="experiment number.")
 
     args = parser.parse_args()
     args = vars(args)
+    # Launched with torchrun, every process trains a replica on its own device.
+    args["rank"], args["local_rank"], args["world_size"] = init_distributed(
+        args["CUDA"]
+    )
+    if args["world_size"] > 1 and args["rep_similarity"]:
+        parser.error("--rep_similarity is not supported with multiple processes")
+    if args["share_dialogue_encoding"] and args["num_future_utterances"] == 0:
+        parser.error("--share_dialogue_encoding needs the future utterances")
+    if args["keep_top_k"] < 1:
+        parser.error("--keep_top_k must be at least 1 to test the best checkpoint")
+    if args["CHUNK_STRIDE"] < 0:
+        parser.error("--CHUNK_STRIDE must not be negative")
+    if args["CHUNK_STRIDE"] > 0 and not args["share_dialogue_encoding"]:
+        parser.error("--CHUNK_STRIDE needs --share_dialogue_encoding")
     device = torch.device(
-        "cuda" if torch.cuda.is_available() and args["CUDA"] is True else "cpu"
+        "cuda:{}".format(args["local_rank"])
+        if torch.cuda.is_available() and args["CUDA"] is True
+        else "cpu"
     )
     args["n_gpu"] = torch.cuda.device_count()
     args["device"] = device
     args["model_save_dir"] = os.path.join(args["model_save_dir"], args["DATASET"])
-    if not os.path.exists(args["model_save_dir"]):
-        os.makedirs(args["model_save_dir"])
+    os.makedirs(args["model_save_dir"], exist_ok=True)
 
     """with open('./train-erc-text.yaml', 'r') as stream:
         args_ = yaml.load(stream, Loader=yaml.FullLoader)
@@ -746,4 +929,8 @@ if __name__ == "__main__":
         args[key] = val"""
 
     logging.info(f"arguments given to {__file__}: {args}")
+    metrics_sink = MetricsSink(args["RESULTS_PATH"])
     main(**args)
+    metrics_sink.close()
+    if is_distributed():
+        torch.distributed.destroy_process_group()
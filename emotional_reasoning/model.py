@@ -1,3 +1,5 @@
+import time
+import logging
 import torch
 from torch import nn
 import numpy as np
@@ -16,6 +18,60 @@ from collections import namedtuple
 from conv import *
 
 
+def spans_to_pos_mask(spans, seq_len):
+    """
+    Expand utterance token spans into position masks.
+    :param spans: [start, end) token spans. Dim: [..., 2]
+    :param seq_len: The length of the token sequence.
+    :return: The 0/1 position masks. Dim: [..., seq_len]
+    """
+    positions = torch.arange(seq_len, device=spans.device)
+    return (positions >= spans[..., 0:1]) & (positions < spans[..., 1:2])
+
+
+def pool_utterances(x, utt_pos_mask):
+    """
+    Average the token representations inside each utterance.
+    :param x: The PLM outputs. Dim: [B, seq_len, D]
+    :param utt_pos_mask: The position masks of the window. Dim: [WIN, B, seq_len]
+    :return: The utterance representations. Dim: [WIN, B, D]
+    """
+    utt_pos_mask = utt_pos_mask.to(x.dtype)
+    utt_xs = torch.einsum("wbt,btd->wbd", utt_pos_mask, x)
+    # Count in float32: under fp16 autocast the 1e-9 would underflow to zero and
+    # turn the empty window slots into NaN.
+    return utt_xs / (torch.sum(utt_pos_mask, dim=-1).float() + 1e-9).unsqueeze(-1)
+
+
+def pool_dialogue_utterances(x, utterance_spans, window_rows):
+    """
+    Build the windows of a batch of targets from shared dialogue encodings.
+    :param x: The PLM outputs of the dialogue chunks. Dim: [C, seq_len, D]
+    :param utterance_spans: The [chunk, start, end) span of every utterance. Dim: [U, 3]
+    :param window_rows: The utterance of each window slot, -1 if masked. Dim: [WIN, B]
+    :return: The utterance representations of the windows. Dim: [WIN, B, D]
+    """
+    seq_len = x.shape[1]
+    # Address every token of every chunk as one flat sequence, and sum the
+    # tokens of each utterance by segment instead of through dense masks.
+    starts = utterance_spans[:, 0] * seq_len + utterance_spans[:, 1]
+    lengths = (utterance_spans[:, 2] - utterance_spans[:, 1]).clamp(min=0)
+    utterances = torch.arange(len(lengths), device=x.device)
+    token_utterance = torch.repeat_interleave(utterances, lengths)
+    segment_starts = torch.cumsum(lengths, dim=0) - lengths
+    token_index = (
+        torch.arange(len(token_utterance), device=x.device)
+        - segment_starts[token_utterance]
+        + starts[token_utterance]
+    )
+    utt_xs = x.new_zeros(len(lengths), x.shape[-1])
+    utt_xs.index_add_(0, token_utterance, x.reshape(-1, x.shape[-1])[token_index])
+    # Count in float32 like pool_utterances.
+    utt_xs = utt_xs / (lengths.float() + 1e-9).unsqueeze(-1)
+    window_xs = utt_xs[window_rows.clamp(min=0)]
+    return window_xs.masked_fill((window_rows < 0).unsqueeze(-1), 0.0)
+
+
 class RobertaClassifier(nn.Module):
     """Fine-tune RoBERTa to directly predict categorical emotions."""
 
@@ -34,17 +90,15 @@ class RobertaClassifier(nn.Module):
             nn.Linear(hidden_size, num_class),
         )
 
-    def forward(self, x, mask, utt_pos_mask):
+    def forward(self, x, mask, utt_pos_spans):
         """
         :param x: The input of PLM. Dim: [B, seq_len, D]
         :param mask: The mask for input x. Dim: [B, seq_len]
+        :param utt_pos_spans: The token spans of the window utterances. Dim: [WIN, B, 2]
         """
         x = self.bert(x, attention_mask=mask)[0]
 
-        utt_xs = x * utt_pos_mask.unsqueeze(-1)
-        utt_xs = torch.sum(utt_xs, dim=2) / (
-            torch.sum(utt_pos_mask, dim=-1) + 1e-9
-        ).unsqueeze(-1)
+        utt_xs = pool_utterances(x, spans_to_pos_mask(utt_pos_spans, x.shape[1]))
         print(utt_xs.shape)
         if self.num_future_utts == 0:
             cuu_pos = utt_xs.shape[0] - 1
@@ -128,6 +182,7 @@ class GNN(nn.Module):
         prev_norm=True,
         last_norm=True,
         use_RTE=True,
+        fused=False,
     ):
         super(GNN, self).__init__()
         self.gcs = nn.ModuleList()
@@ -150,6 +205,7 @@ class GNN(nn.Module):
                     dropout,
                     use_norm=prev_norm,
                     use_RTE=use_RTE,
+                    fused=fused,
                 )
             )
         self.gcs.append(
@@ -163,20 +219,25 @@ class GNN(nn.Module):
                 dropout,
                 use_norm=last_norm,
                 use_RTE=use_RTE,
+                fused=fused,
             )
         )
 
     def forward(self, node_feature, node_type, edge_time, edge_index, edge_type):
-        res = torch.zeros(node_feature.size(0), self.n_hid).to(node_feature.device)
-        for t_id in range(self.num_types):
-            idx = node_type == int(t_id)
-            if idx.sum() == 0:
-                continue
-            res[idx] = torch.tanh(self.adapt_ws[t_id](node_feature[idx]))
-        meta_xs = self.drop(res)
-        del res
-        for gc in self.gcs:
-            meta_xs = gc(meta_xs, node_type, edge_index, edge_type, edge_time)
+        # The graph is small next to the encoder; keep it, and the scatter softmax
+        # over its edges, in float32 under mixed precision.
+        with torch.autocast(node_feature.device.type, enabled=False):
+            node_feature = node_feature.float()
+            res = torch.zeros(node_feature.size(0), self.n_hid).to(node_feature.device)
+            for t_id in range(self.num_types):
+                idx = node_type == int(t_id)
+                if idx.sum() == 0:
+                    continue
+                res[idx] = torch.tanh(self.adapt_ws[t_id](node_feature[idx]))
+            meta_xs = self.drop(res)
+            del res
+            for gc in self.gcs:
+                meta_xs = gc(meta_xs, node_type, edge_index, edge_type, edge_time)
         return meta_xs
 
 
@@ -198,6 +259,7 @@ class MultiDimGNN(nn.Module):
         prev_norm=True,
         last_norm=True,
         use_RTE=True,
+        fused=False,
     ):
         super(MultiDimGNN, self).__init__()
         self.gcs = nn.ModuleList()
@@ -226,6 +288,7 @@ class MultiDimGNN(nn.Module):
                     dropout,
                     use_norm=prev_norm,
                     use_RTE=use_RTE,
+                    fused=fused,
                 )
             )
         self.gcs.append(
@@ -238,26 +301,273 @@ class MultiDimGNN(nn.Module):
                 dropout,
                 use_norm=last_norm,
                 use_RTE=use_RTE,
+                fused=fused,
             )
         )
 
     def forward(self, node_feature, node_type, edge_time, edge_index, edge_type):
-        res = torch.zeros(node_feature.size(0), self.h_dim).to(node_feature.device)
-        for t_id in range(self.num_types):
-            idx = node_type == int(t_id)
-            if t_id in self.h_types:
-                d = self.h_dim
-            else:
-                d = self.l_dim
-            if idx.sum() == 0:
-                continue
-            res[idx, :d] = torch.tanh(self.adapt_ws[t_id](node_feature[idx, :d]))
-        meta_xs = self.drop(res)
-        del res
-        for gc in self.gcs:
-            meta_xs = gc(meta_xs, node_type, edge_index, edge_type, edge_time)
+        # The graph is small next to the encoder; keep it, and the scatter softmax
+        # over its edges, in float32 under mixed precision.
+        with torch.autocast(node_feature.device.type, enabled=False):
+            node_feature = node_feature.float()
+            res = torch.zeros(node_feature.size(0), self.h_dim).to(node_feature.device)
+            for t_id in range(self.num_types):
+                idx = node_type == int(t_id)
+                if t_id in self.h_types:
+                    d = self.h_dim
+                else:
+                    d = self.l_dim
+                if idx.sum() == 0:
+                    continue
+                res[idx, :d] = torch.tanh(self.adapt_ws[t_id](node_feature[idx, :d]))
+            meta_xs = self.drop(res)
+            del res
+            for gc in self.gcs:
+                meta_xs = gc(meta_xs, node_type, edge_index, edge_type, edge_time)
         return meta_xs
 
+    def forward_split(
+        self, h_feature, l_feature, node_type, edge_time, edge_index, edge_type
+    ):
+        """
+        Run the GNN on per-type node storage instead of zero-padding the l-type
+        nodes to h_dim.
+        :param h_feature: The h-type nodes, in node order. Dim: [N_h, h_dim]
+        :param l_feature: The l-type nodes, in node order. Dim: [N_l, l_dim]
+        :return: The outputs of the h-type and l-type nodes, and the row of every
+            node in its store. Dim: [N]
+        """
+        with torch.autocast(h_feature.device.type, enabled=False):
+            is_h = self.gcs[0].is_h_type(node_type)
+            local_index = torch.where(
+                is_h, torch.cumsum(is_h, dim=0) - 1, torch.cumsum(~is_h, dim=0) - 1
+            )
+            stores = []
+            for feature, types in [
+                (h_feature, node_type[is_h]),
+                (l_feature, node_type[~is_h]),
+            ]:
+                feature = feature.float()
+                res = torch.zeros_like(feature)
+                for t_id in range(self.num_types):
+                    idx = types == int(t_id)
+                    if idx.sum() == 0:
+                        continue
+                    res[idx] = torch.tanh(self.adapt_ws[t_id](feature[idx]))
+                stores.append(self.drop(res))
+            h_xs, l_xs = stores
+            for gc in self.gcs:
+                h_xs, l_xs = gc.forward_split(
+                    h_xs, l_xs, node_type, local_index, edge_index, edge_type, edge_time
+                )
+        return h_xs, l_xs, local_index
+
+
+def window_node_types(batch_size, win_size, num_slots, device=None):
+    """
+    The node types of a batch of window graphs. The graph of each sample holds
+    WIN utterance (0), WIN forward aggregate (1) and WIN backward aggregate (2)
+    nodes, followed by num_slots knowledge nodes (3) per window slot.
+    :return: Dim: [B * WIN * (3 + num_slots)]
+    """
+    counts = torch.tensor(
+        [win_size, win_size, win_size, win_size * num_slots], device=device
+    )
+    node_type = torch.repeat_interleave(torch.arange(4, device=device), counts)
+    return node_type.repeat(batch_size)
+
+
+def window_edges(utt_mask, num_slots, connect_matrix=None):
+    """
+    Build the edges of a batch of window graphs with tensor ops. The edges of
+    every sample follow the same template, which is filtered by the masks; the
+    edges come out in the order of the former per-edge loops.
+    - utterance j -> forward and backward aggregate j (type 0, time 2)
+    - forward aggregate j -> utterance k for k >= j (type 1, time 2)
+    - backward aggregate j -> utterance k for k <= j (type 2, time 2)
+    - knowledge node m of slot j -> forward and backward aggregate j (type 3, time 0)
+    Only edges between unmasked slots are kept.
+    :param utt_mask: The mask of the window slots. Dim: [B, WIN]
+    :param num_slots: The number of knowledge nodes per window slot.
+    :param connect_matrix: Which knowledge nodes are connected, all if None.
+        Dim: [B, WIN, num_slots]
+    :return: edge_index [2, E], edge_type [E] and edge_time [E]
+    """
+    batch_size, win_size = utt_mask.shape
+    device = utt_mask.device
+    valid = utt_mask != 0
+    slots = torch.arange(win_size, device=device)
+    aggregates = torch.stack([slots + win_size, slots + 2 * win_size], dim=1)
+
+    forward_j, forward_k = torch.triu_indices(win_size, win_size, device=device)
+    backward_j, backward_k = torch.tril_indices(win_size, win_size, device=device)
+    know_nodes = 3 * win_size + torch.arange(win_size * num_slots, device=device)
+    know_slots = slots.repeat_interleave(num_slots)
+    know_valid = valid.unsqueeze(-1).expand(-1, -1, num_slots)
+    if connect_matrix is not None:
+        know_valid = know_valid & connect_matrix
+    know_valid = know_valid.reshape(batch_size, -1)
+
+    source = torch.cat(
+        [
+            slots.repeat_interleave(2),
+            forward_j + win_size,
+            backward_j + 2 * win_size,
+            know_nodes.repeat_interleave(2),
+        ]
+    )
+    target = torch.cat(
+        [
+            aggregates.flatten(),
+            forward_k,
+            backward_k,
+            aggregates[know_slots].flatten(),
+        ]
+    )
+    sizes = [2 * win_size, len(forward_j), len(backward_j), 2 * win_size * num_slots]
+    template_type = torch.repeat_interleave(
+        torch.arange(4, device=device), torch.tensor(sizes, device=device)
+    )
+    template_time = torch.full_like(template_type, 2).masked_fill(
+        template_type == 3, 0
+    )
+    edge_valid = torch.cat(
+        [
+            valid.repeat_interleave(2, dim=1),
+            valid[:, forward_j] & valid[:, forward_k],
+            valid[:, backward_j] & valid[:, backward_k],
+            know_valid.repeat_interleave(2, dim=1),
+        ],
+        dim=1,
+    )
+
+    # Boolean indexing walks the [B, E] masks row by row, which keeps the edges
+    # grouped by sample.
+    offsets = torch.arange(batch_size, device=device).unsqueeze(1) * (
+        win_size * (3 + num_slots)
+    )
+    edge_index = torch.stack(
+        [(source + offsets)[edge_valid], (target + offsets)[edge_valid]]
+    )
+    edge_type = template_type.expand(batch_size, -1)[edge_valid]
+    edge_time = template_time.expand(batch_size, -1)[edge_valid]
+    return edge_index, edge_type, edge_time
+
+
+def compact_window_graph(node_feature, node_type, edge_index, utt_mask, num_slots):
+    """
+    Drop the nodes of the masked window slots, which have no edges.
+    :param node_feature: The node features of the full window graphs, or the
+        utterance and other node features of split_make_graph. Dim: [B * N, D]
+    :param utt_mask: The mask of the window slots. Dim: [B, WIN]
+    :return: The node features, node types and edges of the kept nodes, and the
+        map from the node indices of the full graphs to the kept ones. Dim: [B * N]
+    """
+    win_size = utt_mask.shape[1]
+    slots = torch.arange(win_size, device=utt_mask.device)
+    node_slots = torch.cat([slots, slots, slots, slots.repeat_interleave(num_slots)])
+    keep = (utt_mask != 0)[:, node_slots].flatten()
+    node_map = torch.cumsum(keep, dim=0) - 1
+    if isinstance(node_feature, tuple):
+        # Per-type node storage: the utterance nodes, then the other nodes.
+        is_utterance = node_type == 0
+        node_feature = (
+            node_feature[0][keep[is_utterance]],
+            node_feature[1][keep[~is_utterance]],
+        )
+    else:
+        node_feature = node_feature[keep]
+    return node_feature, node_type[keep], node_map[edge_index], node_map
+
+
+class WindowEdgeCache:
+    """
+    Cache the edges of single window graphs by their topology.
+
+    The edges of a sample only depend on the window size, the number of knowledge
+    slots and the 0/1 pattern of its window mask (and ConceptNet connect matrix),
+    and only a few patterns occur, from the truncation at the dialogue edges. A
+    batch is assembled from the cached edges of its samples, shifted to their
+    node offsets, so window_edges only runs for unseen patterns.
+    """
+
+    def __init__(self, max_templates=100000):
+        """
+        :param max_templates: Stop adding templates beyond this many, which only
+            ConceptNet connect matrices can reach.
+        """
+        self.max_templates = max_templates
+        self.templates = {}
+        self.hits = 0
+        self.misses = 0
+        self.build_seconds = 0.0
+
+    def __call__(self, utt_mask, num_slots, connect_matrix=None):
+        """Same arguments and outputs as window_edges."""
+        start = time.perf_counter()
+        with torch.autograd.profiler.record_function("window_edge_cache"):
+            batch_size, win_size = utt_mask.shape
+            bits = utt_mask != 0
+            if connect_matrix is not None:
+                bits = torch.cat([bits, connect_matrix.reshape(batch_size, -1)], dim=1)
+            templates = []
+            for i, row in enumerate(bits.cpu().numpy()):
+                key = (win_size, num_slots, row.tobytes())
+                template = self.templates.get(key)
+                if template is None:
+                    self.misses += 1
+                    template = window_edges(
+                        utt_mask[i : i + 1],
+                        num_slots,
+                        None if connect_matrix is None else connect_matrix[i : i + 1],
+                    )
+                    if len(self.templates) < self.max_templates:
+                        self.templates[key] = template
+                else:
+                    self.hits += 1
+                templates.append(template)
+
+            num_edges = torch.tensor(
+                [template[1].shape[0] for template in templates],
+                device=utt_mask.device,
+            )
+            offsets = torch.arange(batch_size, device=utt_mask.device) * (
+                win_size * (3 + num_slots)
+            )
+            edge_index = torch.cat([template[0] for template in templates], dim=1)
+            edge_index = edge_index + offsets.repeat_interleave(num_edges)
+            edge_type = torch.cat([template[1] for template in templates])
+            edge_time = torch.cat([template[2] for template in templates])
+        self.build_seconds += time.perf_counter() - start
+        return edge_index, edge_type, edge_time
+
+    def summary(self):
+        """The hit rate and build time since the last reset_stats."""
+        hit_rate = self.hits / max(self.hits + self.misses, 1) * 100
+        return (
+            f"edge cache: {len(self.templates)} templates, hit rate {hit_rate:.2f}%, "
+            f"build time {self.build_seconds:.3f}s"
+        )
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.build_seconds = 0.0
+
+
+def compile_fn(fn):
+    """
+    Compile fn with torch.compile, marking every dimension as dynamic so that new
+    batch sizes, sequence lengths and graph sizes reuse the compiled code instead
+    of recompiling. torch versions without torch.compile return fn unchanged.
+    """
+    if not hasattr(torch, "compile"):
+        logging.warning(
+            f"torch {torch.__version__} has no torch.compile; running eagerly"
+        )
+        return fn
+    return torch.compile(fn, dynamic=True)
+
 
 class VIBERC(nn.Module):
     """The BHG model for ERC task."""
@@ -293,6 +603,7 @@ class VIBERC(nn.Module):
                 num_types=4,
                 num_relations=4,
                 use_RTE=False,
+                fused=args["fused_hgt"],
             )
         else:
             self.gnn = GNN(
@@ -305,6 +616,7 @@ class VIBERC(nn.Module):
                 num_types=4,
                 num_relations=4,
                 use_RTE=False,
+                fused=args["fused_hgt"],
             )
 
         self.context2params = nn.ModuleDict()
@@ -341,6 +653,28 @@ class VIBERC(nn.Module):
             nn.Dropout(self.config.hidden_dropout_prob),
             nn.Linear(hidden_size, num_class),
         )
+        self.pool_utterances = pool_utterances
+        self.pool_dialogue_utterances = pool_dialogue_utterances
+        self.edge_cache = WindowEdgeCache()
+        self.compact_graph = args["compact_graph"]
+        # Per-type node storage only applies to the multi-dimensional HGT.
+        self.split_nodes = args["split_nodes"] and self.conv_name == "multidim_hgt"
+
+    def enable_compile(self):
+        """
+        Compile the parts of the forward pass with few distinct shapes: the
+        utterance pooling, the GNN layers and the classifier head. The encoder and
+        the graph construction stay eager. Only the forward functions are
+        replaced, so state dicts and checkpoints are unchanged.
+        """
+        self.pool_utterances = compile_fn(pool_utterances)
+        self.pool_dialogue_utterances = compile_fn(pool_dialogue_utterances)
+        self.gnn.forward = compile_fn(self.gnn.forward)
+        if self.split_nodes:
+            self.gnn.forward_split = compile_fn(self.gnn.forward_split)
+        self.cu_utt_emo_prediction_layers.forward = compile_fn(
+            self.cu_utt_emo_prediction_layers.forward
+        )
 
     def scaled_dot_product_attention(self, Q, K, V, mask=None):
         """
@@ -353,10 +687,12 @@ class VIBERC(nn.Module):
         attn_weights = torch.matmul(K, Q.unsqueeze(-1)).squeeze(-1) / torch.sqrt(
             torch.tensor(Q.shape[-1])
         )
+        # -100000.0 overflows float16, so mask and normalize in float32.
+        attn_weights = attn_weights.float()
         if mask is not None:
             mask = (1.0 - mask) * -100000.0
             attn_weights = attn_weights + mask
-        attn_weights = torch.softmax(attn_weights, dim=-1)
+        attn_weights = torch.softmax(attn_weights, dim=-1).to(V.dtype)
         return torch.matmul(attn_weights.unsqueeze(-2), V).squeeze(-2)
 
     def compute_latent_params(self, context, layer, mode="train"):
@@ -442,97 +778,17 @@ class VIBERC(nn.Module):
             dim=1,
         ).view(-1, comet_feature.shape[-1])
 
-        node_type = torch.LongTensor(
-            (
-                [0] * utt_feature.shape[1]
-                + [1] * utt_feature.shape[1]
-                + [2] * utt_feature.shape[1]
-                + [3] * (utt_feature.shape[1] * comet_feature.shape[-2])
-            )
-            * utt_feature.shape[0]
+        node_type = window_node_types(
+            utt_feature.shape[0],
+            utt_feature.shape[1],
+            comet_feature.shape[-2],
+            utt_feature.device,
+        )
+        edge_index, edge_type, edge_time = self.edge_cache(
+            utt_mask,
+            comet_feature.shape[-2],
+            connect_matrix if self.conceptnet else None,
         )
-
-        edge_index = [[], []]
-        edge_type = []
-        edge_time = []
-        for i in range(utt_feature.shape[0]):
-            cuu_source = []
-            cuu_target = []
-            for j in range(utt_feature.shape[1]):
-                if utt_mask[i, j] == 0:
-                    continue
-                cuu_source.append(j)
-                cuu_target.append(j + utt_feature.shape[1])
-                edge_type.append(0)
-                edge_time.append(2)
-
-                cuu_source.append(j)
-                cuu_target.append(j + 2 * utt_feature.shape[1])
-                edge_type.append(0)
-                edge_time.append(2)
-
-            for j in range(utt_feature.shape[1], 2 * utt_feature.shape[1]):
-                if utt_mask[i, j - utt_feature.shape[1]] == 0:
-                    continue
-                for k in range(j - utt_feature.shape[1], utt_feature.shape[1]):
-                    if utt_mask[i, k] == 0:
-                        continue
-                    cuu_source.append(j)
-                    cuu_target.append(k)
-                    edge_type.append(1)
-                    edge_time.append(2)
-
-            for j in range(2 * utt_feature.shape[1], 3 * utt_feature.shape[1]):
-                if utt_mask[i, j - 2 * utt_feature.shape[1]] == 0:
-                    continue
-                for k in range(0, j - 2 * utt_feature.shape[1] + 1):
-                    if utt_mask[i, k] == 0:
-                        continue
-                    cuu_source.append(j)
-                    cuu_target.append(k)
-                    edge_type.append(2)
-                    edge_time.append(2)
-
-            for j in range(utt_feature.shape[1], 2 * utt_feature.shape[1]):
-                if utt_mask[i, j - utt_feature.shape[1]] == 0:
-                    continue
-                s = 3 * utt_feature.shape[1] + comet_feature.shape[-2] * (
-                    j - utt_feature.shape[1]
-                )
-                for k in range(s, s + comet_feature.shape[-2]):
-                    if self.conceptnet:
-                        if connect_matrix[i, j - utt_feature.shape[1], k - s]:
-                            cuu_source.append(k)
-                            cuu_target.append(j)
-                            edge_type.append(3)
-                            edge_time.append(0)
-
-                            cuu_source.append(k)
-                            cuu_target.append(j + utt_feature.shape[1])
-                            edge_type.append(3)
-                            edge_time.append(0)
-                    else:
-                        cuu_source.append(k)
-                        cuu_target.append(j)
-                        edge_type.append(3)
-                        edge_time.append(0)
-
-                        cuu_source.append(k)
-                        cuu_target.append(j + utt_feature.shape[1])
-                        edge_type.append(3)
-                        edge_time.append(0)
-
-            edge_index[0] += [
-                j + i * int(node_feature.shape[0] / utt_feature.shape[0])
-                for j in cuu_source
-            ]
-            edge_index[1] += [
-                j + i * int(node_feature.shape[0] / utt_feature.shape[0])
-                for j in cuu_target
-            ]
-        edge_index = torch.LongTensor(edge_index)
-        edge_type = torch.LongTensor(edge_type)
-        edge_time = torch.LongTensor(edge_time)
 
         return (
             node_feature.to(self.device),
@@ -542,6 +798,56 @@ class VIBERC(nn.Module):
             edge_time.to(self.device),
         )
 
+    def split_make_graph(
+        self,
+        utt_feature,
+        utt_mask,
+        agg_feature_forward,
+        agg_feature_back,
+        comet_feature,
+    ):
+        """
+        Build the graph of keepdim_make_graph with per-type node storage: the
+        utterance nodes keep the encoder width and the aggregate and knowledge
+        nodes the COMET width, instead of being zero-padded to the encoder width.
+        :param utt_feature: [B, WIN, D1]
+        :param utt_mask: [B, WIN]
+        :param agg_feature_forward: [B, WIN, D2]
+        :param agg_feature_back: [B, WIN, D2]
+        :param comet_feature: [B, WIN, 9, D2]
+        :return: The utterance [B * WIN, D1] and other [B * WIN * 11, D2] node
+            features, then node_type, edge_index, edge_type and edge_time.
+        """
+        if self.conceptnet:
+            connect_matrix = torch.sum(comet_feature, dim=-1) != 0
+        h_feature = utt_feature.reshape(-1, utt_feature.shape[-1])
+        l_feature = torch.cat(
+            [
+                agg_feature_forward,
+                agg_feature_back,
+                comet_feature.view(comet_feature.shape[0], -1, comet_feature.shape[-1]),
+            ],
+            dim=1,
+        ).view(-1, comet_feature.shape[-1])
+        node_type = window_node_types(
+            utt_feature.shape[0],
+            utt_feature.shape[1],
+            comet_feature.shape[-2],
+            utt_feature.device,
+        )
+        edge_index, edge_type, edge_time = self.edge_cache(
+            utt_mask,
+            comet_feature.shape[-2],
+            connect_matrix if self.conceptnet else None,
+        )
+        return (
+            (h_feature.to(self.device), l_feature.to(self.device)),
+            node_type.to(self.device),
+            edge_index.to(self.device),
+            edge_type.to(self.device),
+            edge_time.to(self.device),
+        )
+
     def make_graph(
         self,
         utt_feature,
@@ -570,97 +876,17 @@ class VIBERC(nn.Module):
             dim=1,
         ).view(-1, comet_feature.shape[-1])
 
-        node_type = torch.LongTensor(
-            (
-                [0] * utt_feature.shape[1]
-                + [1] * utt_feature.shape[1]
-                + [2] * utt_feature.shape[1]
-                + [3] * (utt_feature.shape[1] * comet_feature.shape[-2])
-            )
-            * utt_feature.shape[0]
+        node_type = window_node_types(
+            utt_feature.shape[0],
+            utt_feature.shape[1],
+            comet_feature.shape[-2],
+            utt_feature.device,
+        )
+        edge_index, edge_type, edge_time = self.edge_cache(
+            utt_mask,
+            comet_feature.shape[-2],
+            connect_matrix if self.conceptnet else None,
         )
-
-        edge_index = [[], []]
-        edge_type = []
-        edge_time = []
-        for i in range(utt_feature.shape[0]):
-            cuu_source = []
-            cuu_target = []
-            for j in range(utt_feature.shape[1]):
-                if utt_mask[i, j] == 0:
-                    continue
-                cuu_source.append(j)
-                cuu_target.append(j + utt_feature.shape[1])
-                edge_type.append(0)
-                edge_time.append(2)
-
-                cuu_source.append(j)
-                cuu_target.append(j + 2 * utt_feature.shape[1])
-                edge_type.append(0)
-                edge_time.append(2)
-
-            for j in range(utt_feature.shape[1], 2 * utt_feature.shape[1]):
-                if utt_mask[i, j - utt_feature.shape[1]] == 0:
-                    continue
-                for k in range(j - utt_feature.shape[1], utt_feature.shape[1]):
-                    if utt_mask[i, k] == 0:
-                        continue
-                    cuu_source.append(j)
-                    cuu_target.append(k)
-                    edge_type.append(1)
-                    edge_time.append(2)
-
-            for j in range(2 * utt_feature.shape[1], 3 * utt_feature.shape[1]):
-                if utt_mask[i, j - 2 * utt_feature.shape[1]] == 0:
-                    continue
-                for k in range(0, j - 2 * utt_feature.shape[1] + 1):
-                    if utt_mask[i, k] == 0:
-                        continue
-                    cuu_source.append(j)
-                    cuu_target.append(k)
-                    edge_type.append(2)
-                    edge_time.append(2)
-
-            for j in range(utt_feature.shape[1], 2 * utt_feature.shape[1]):
-                if utt_mask[i, j - utt_feature.shape[1]] == 0:
-                    continue
-                s = 3 * utt_feature.shape[1] + comet_feature.shape[-2] * (
-                    j - utt_feature.shape[1]
-                )
-                for k in range(s, s + comet_feature.shape[-2]):
-                    if self.conceptnet:
-                        if connect_matrix[i, j - utt_feature.shape[1], k - s]:
-                            cuu_source.append(k)
-                            cuu_target.append(j)
-                            edge_type.append(3)
-                            edge_time.append(0)
-
-                            cuu_source.append(k)
-                            cuu_target.append(j + utt_feature.shape[1])
-                            edge_type.append(3)
-                            edge_time.append(0)
-                    else:
-                        cuu_source.append(k)
-                        cuu_target.append(j)
-                        edge_type.append(3)
-                        edge_time.append(0)
-
-                        cuu_source.append(k)
-                        cuu_target.append(j + utt_feature.shape[1])
-                        edge_type.append(3)
-                        edge_time.append(0)
-
-            edge_index[0] += [
-                j + i * int(node_feature.shape[0] / utt_feature.shape[0])
-                for j in cuu_source
-            ]
-            edge_index[1] += [
-                j + i * int(node_feature.shape[0] / utt_feature.shape[0])
-                for j in cuu_target
-            ]
-        edge_index = torch.LongTensor(edge_index)
-        edge_type = torch.LongTensor(edge_type)
-        edge_time = torch.LongTensor(edge_time)
 
         return (
             node_feature.to(self.device),
@@ -676,17 +902,91 @@ class VIBERC(nn.Module):
         )
         return result
 
-    def forward(self, inputs, mask, utt_pos_mask, comet_inputs, comet_mask):
+    def select_nodes(self, hgt_features, indices, node_map=None):
+        """
+        :param indices: Node indices in the full window graphs.
+        :param node_map: The node map of compact_window_graph, if it was applied.
+        """
+        indices = indices.to(self.device)
+        if node_map is not None:
+            indices = node_map[indices]
+        return torch.index_select(hgt_features, 0, indices)
+
+    def knowledge_similarity(
+        self,
+        hgt_features,
+        batch_size,
+        cuu_know_pos_f,
+        cuu_know_pos_b,
+        cuu_input_know,
+        num_knowledge,
+        num_nodes,
+        node_map=None,
+    ):
+        """
+        Compare the aggregated knowledge nodes of each target with its COMET nodes.
+        :param num_nodes: The number of nodes of a full window graph.
+        :param node_map: The node map of compact_window_graph, if it was applied.
+        :return: The cosine similarities of the forward and backward aggregation
+            nodes with every knowledge node of the target. Dim: [B, K]
+        """
+        know_indices_f = torch.LongTensor(
+            [cuu_know_pos_f + i * num_nodes for i in range(batch_size)]
+        )
+        know_indices_b = torch.LongTensor(
+            [cuu_know_pos_b + i * num_nodes for i in range(batch_size)]
+        )
+        comet_know_indices = []
+        for i in range(batch_size):
+            comet_know_indices += [
+                cuu_input_know + i * num_nodes + j for j in range(num_knowledge)
+            ]
+        comet_know_indices = torch.LongTensor(comet_know_indices)
+        know_features_f = self.select_nodes(hgt_features, know_indices_f, node_map)[
+            :, : self.comet_hidden_size
+        ]
+        know_features_b = self.select_nodes(hgt_features, know_indices_b, node_map)[
+            :, : self.comet_hidden_size
+        ]
+        comet_features_output = self.select_nodes(
+            hgt_features, comet_know_indices, node_map
+        )[:, : self.comet_hidden_size]
+        comet_features_output = comet_features_output.reshape(
+            batch_size, -1, comet_features_output.shape[-1]
+        )
+        f_cos = self.cos_similarity(know_features_f, comet_features_output).detach()
+        b_cos = self.cos_similarity(know_features_b, comet_features_output).detach()
+        return f_cos, b_cos
+
+    def forward(
+        self,
+        inputs,
+        mask,
+        utt_pos_spans,
+        comet_inputs,
+        comet_mask,
+        window_rows=None,
+        return_similarity=False,
+    ):
         """
         :param inputs: The input of PLM. Dim: [B, seq_len]
         :param mask: The mask for input x. Dim: [B, seq_len]
+        :param utt_pos_spans: The token spans of the window utterances. Dim: [WIN, B, 2]
+        :param window_rows: Set when the dialogues are encoded once for all their
+            targets. inputs and mask then hold the dialogue chunks [C, seq_len],
+            utt_pos_spans the [chunk, start, end) spans of their utterances
+            [U, 3], and window_rows the utterance of each window slot [WIN, B].
+        :param return_similarity: Also return the knowledge similarity diagnostics
+            of knowledge_similarity; otherwise they are None.
         """
         x = self.encoder(inputs, attention_mask=mask)[0]
 
-        utt_xs = x * utt_pos_mask.unsqueeze(-1)
-        utt_xs = torch.sum(utt_xs, dim=2) / (
-            torch.sum(utt_pos_mask, dim=-1) + 1e-9
-        ).unsqueeze(-1)
+        if window_rows is None:
+            utt_xs = self.pool_utterances(
+                x, spans_to_pos_mask(utt_pos_spans, x.shape[1])
+            )
+        else:
+            utt_xs = self.pool_dialogue_utterances(x, utt_pos_spans, window_rows)
 
         if self.num_future_utts == 0:
             cuu_pos = utt_xs.shape[0] - 1
@@ -727,7 +1027,17 @@ class VIBERC(nn.Module):
         # comet_utt_f = self.comet_utt_f.repeat(inputs.shape[0], 1, 1)
         # comet_utt_b = self.comet_utt_b.repeat(inputs.shape[0], 1, 1)
 
-        if self.conv_name == "multidim_hgt":
+        if self.split_nodes:
+            (
+                node_feature,
+                node_type,
+                edge_index,
+                edge_type,
+                edge_time,
+            ) = self.split_make_graph(
+                utt_xs, comet_mask, comet_utt_f, comet_utt_b, comet_inputs
+            )
+        elif self.conv_name == "multidim_hgt":
             (
                 node_feature,
                 node_type,
@@ -743,54 +1053,43 @@ class VIBERC(nn.Module):
             node_feature, node_type, edge_index, edge_type, edge_time = self.make_graph(
                 utt_xs, comet_mask, comet_utt_f, comet_utt_b, comet_inputs
             )
-        hgt_features = self.gnn(
-            node_feature, node_type, edge_time, edge_index, edge_type
-        )
+        # Nodes are addressed by their index in the full window graphs, which
+        # node_map translates when the masked slots are dropped.
+        num_nodes = utt_xs.shape[1] * (3 + comet_inputs.shape[2])
+        node_map = None
+        if self.compact_graph:
+            node_feature, node_type, edge_index, node_map = compact_window_graph(
+                node_feature, node_type, edge_index, comet_mask, comet_inputs.shape[2]
+            )
+        if self.split_nodes:
+            # The target is an utterance node, the similarity diagnostics read
+            # aggregate and knowledge nodes, so each reads one store.
+            h_features, l_features, local_index = self.gnn.forward_split(
+                *node_feature, node_type, edge_time, edge_index, edge_type
+            )
+            node_map = local_index if node_map is None else local_index[node_map]
+        else:
+            h_features = l_features = self.gnn(
+                node_feature, node_type, edge_time, edge_index, edge_type
+            )
 
         indices = torch.LongTensor(
-            [
-                cuu_pos + i * int(hgt_features.shape[0] / utt_xs.shape[0])
-                for i in range(utt_xs.shape[0])
-            ]
-        )
-        know_indices_f = torch.LongTensor(
-            [
-                cuu_know_pos_f + i * int(hgt_features.shape[0] / utt_xs.shape[0])
-                for i in range(utt_xs.shape[0])
-            ]
-        )
-        know_indices_b = torch.LongTensor(
-            [
-                cuu_know_pos_b + i * int(hgt_features.shape[0] / utt_xs.shape[0])
-                for i in range(utt_xs.shape[0])
-            ]
-        )
-        comet_know_indices = []
-        for i in range(utt_xs.shape[0]):
-            comet_know_indices += [
-                cuu_input_know + i * int(hgt_features.shape[0] / utt_xs.shape[0]) + j
-                for j in range(comet_inputs.shape[2])
-            ]
-        comet_know_indices = torch.LongTensor(comet_know_indices)
-        tgt_features = torch.index_select(hgt_features, 0, indices.to(self.device))
-        know_features_f = torch.index_select(
-            hgt_features, 0, know_indices_f.to(self.device)
-        )[:, : self.comet_hidden_size]
-        know_features_b = torch.index_select(
-            hgt_features, 0, know_indices_b.to(self.device)
-        )[:, : self.comet_hidden_size]
-        comet_features_output = torch.index_select(
-            hgt_features, 0, comet_know_indices.to(self.device)
-        )[:, : self.comet_hidden_size]
-        comet_features_output = comet_features_output.reshape(
-            utt_xs.shape[0], -1, comet_features_output.shape[-1]
-        )
-        f_cos = (
-            self.cos_similarity(know_features_f, comet_features_output).detach().cpu()
-        )
-        b_cos = (
-            self.cos_similarity(know_features_b, comet_features_output).detach().cpu()
+            [cuu_pos + i * num_nodes for i in range(utt_xs.shape[0])]
         )
+        tgt_features = self.select_nodes(h_features, indices, node_map)
+        if return_similarity:
+            f_cos, b_cos = self.knowledge_similarity(
+                l_features,
+                utt_xs.shape[0],
+                cuu_know_pos_f,
+                cuu_know_pos_b,
+                cuu_input_know,
+                comet_inputs.shape[2],
+                num_nodes,
+                node_map,
+            )
+        else:
+            f_cos, b_cos = None, None
 
         latent_params = dict()
         """latent_params['utt'] = self.compute_latent_params(torch.cat([tgt_features, know_features_f, know_features_b], dim=1), self.context2params['utt'])
@@ -839,6 +1138,7 @@ class CasualVIBERC(nn.Module):
                 num_types=4,
                 num_relations=4,
                 use_RTE=False,
+                fused=args["fused_hgt"],
             )
         else:
             self.gnn = GNN(
@@ -851,6 +1151,7 @@ class CasualVIBERC(nn.Module):
                 num_types=4,
                 num_relations=4,
                 use_RTE=False,
+                fused=args["fused_hgt"],
             )
 
         self.context2params = nn.ModuleDict()
@@ -905,10 +1206,12 @@ class CasualVIBERC(nn.Module):
         attn_weights = torch.matmul(K, Q.unsqueeze(-1)).squeeze(-1) / torch.sqrt(
             torch.tensor(Q.shape[-1])
         )
+        # -100000.0 overflows float16, so mask and normalize in float32.
+        attn_weights = attn_weights.float()
         if mask is not None:
             mask = (1.0 - mask) * -100000.0
             attn_weights = attn_weights + mask
-        attn_weights = torch.softmax(attn_weights, dim=-1)
+        attn_weights = torch.softmax(attn_weights, dim=-1).to(V.dtype)
         return torch.matmul(attn_weights.unsqueeze(-2), V).squeeze(-2)
 
     def compute_latent_params(self, context, layer, mode="train"):
@@ -989,85 +1292,18 @@ class CasualVIBERC(nn.Module):
             dim=1,
         ).view(-1, comet_feature.shape[-1])
 
-        node_type = torch.LongTensor(
-            (
-                [0] * utt_feature.shape[1]
-                + [1] * utt_feature.shape[1]
-                + [2] * utt_feature.shape[1]
-                + [3] * (utt_feature.shape[1] * comet_feature.shape[-2])
-            )
-            * utt_feature.shape[0]
+        node_type = window_node_types(
+            utt_feature.shape[0],
+            utt_feature.shape[1],
+            comet_feature.shape[-2],
+            utt_feature.device,
+        )
+        # Every window slot of a RECCON dialogue is present.
+        edge_index, edge_type, edge_time = window_edges(
+            torch.ones(utt_feature.shape[:2], device=utt_feature.device),
+            comet_feature.shape[-2],
+            connect_matrix if self.conceptnet else None,
         )
-
-        edge_index = [[], []]
-        edge_type = []
-        edge_time = []
-        for i in range(utt_feature.shape[0]):
-            cuu_source = []
-            cuu_target = []
-            for j in range(utt_feature.shape[1]):
-                cuu_source.append(j)
-                cuu_target.append(j + utt_feature.shape[1])
-                edge_type.append(0)
-                edge_time.append(2)
-
-                cuu_source.append(j)
-                cuu_target.append(j + 2 * utt_feature.shape[1])
-                edge_type.append(0)
-                edge_time.append(2)
-
-            for j in range(utt_feature.shape[1], 2 * utt_feature.shape[1]):
-                for k in range(j - utt_feature.shape[1], utt_feature.shape[1]):
-                    cuu_source.append(j)
-                    cuu_target.append(k)
-                    edge_type.append(1)
-                    edge_time.append(2)
-
-            for j in range(2 * utt_feature.shape[1], 3 * utt_feature.shape[1]):
-                for k in range(0, j - 2 * utt_feature.shape[1] + 1):
-                    cuu_source.append(j)
-                    cuu_target.append(k)
-                    edge_type.append(2)
-                    edge_time.append(2)
-
-            for j in range(utt_feature.shape[1], 2 * utt_feature.shape[1]):
-                s = 3 * utt_feature.shape[1] + comet_feature.shape[-2] * (
-                    j - utt_feature.shape[1]
-                )
-                for k in range(s, s + comet_feature.shape[-2]):
-                    if self.conceptnet:
-                        if connect_matrix[i, j - utt_feature.shape[1], k - s]:
-                            cuu_source.append(k)
-                            cuu_target.append(j)
-                            edge_type.append(3)
-                            edge_time.append(0)
-
-                            cuu_source.append(k)
-                            cuu_target.append(j + utt_feature.shape[1])
-                            edge_type.append(3)
-                            edge_time.append(0)
-                    else:
-                        cuu_source.append(k)
-                        cuu_target.append(j)
-                        edge_type.append(3)
-                        edge_time.append(0)
-
-                        cuu_source.append(k)
-                        cuu_target.append(j + utt_feature.shape[1])
-                        edge_type.append(3)
-                        edge_time.append(0)
-
-            edge_index[0] += [
-                j + i * int(node_feature.shape[0] / utt_feature.shape[0])
-                for j in cuu_source
-            ]
-            edge_index[1] += [
-                j + i * int(node_feature.shape[0] / utt_feature.shape[0])
-                for j in cuu_target
-            ]
-        edge_index = torch.LongTensor(edge_index)
-        edge_type = torch.LongTensor(edge_type)
-        edge_time = torch.LongTensor(edge_time)
 
         return (
             node_feature.to(self.device),
@@ -1098,73 +1334,17 @@ class CasualVIBERC(nn.Module):
             dim=1,
         ).view(-1, comet_feature.shape[-1])
 
-        node_type = torch.LongTensor(
-            (
-                [0] * utt_feature.shape[1]
-                + [1] * utt_feature.shape[1]
-                + [2] * utt_feature.shape[1]
-                + [3] * (utt_feature.shape[1] * comet_feature.shape[-2])
-            )
-            * utt_feature.shape[0]
+        node_type = window_node_types(
+            utt_feature.shape[0],
+            utt_feature.shape[1],
+            comet_feature.shape[-2],
+            utt_feature.device,
+        )
+        # Every window slot of a RECCON dialogue is present.
+        edge_index, edge_type, edge_time = window_edges(
+            torch.ones(utt_feature.shape[:2], device=utt_feature.device),
+            comet_feature.shape[-2],
         )
-
-        edge_index = [[], []]
-        edge_type = []
-        edge_time = []
-        for i in range(utt_feature.shape[0]):
-            cuu_source = []
-            cuu_target = []
-            for j in range(utt_feature.shape[1]):
-                cuu_source.append(j)
-                cuu_target.append(j + utt_feature.shape[1])
-                edge_type.append(0)
-                edge_time.append(2)
-
-                cuu_source.append(j)
-                cuu_target.append(j + 2 * utt_feature.shape[1])
-                edge_type.append(0)
-                edge_time.append(2)
-
-            for j in range(utt_feature.shape[1], 2 * utt_feature.shape[1]):
-                for k in range(j - utt_feature.shape[1], utt_feature.shape[1]):
-                    cuu_source.append(j)
-                    cuu_target.append(k)
-                    edge_type.append(1)
-                    edge_time.append(2)
-
-            for j in range(2 * utt_feature.shape[1], 3 * utt_feature.shape[1]):
-                for k in range(0, j - 2 * utt_feature.shape[1] + 1):
-                    cuu_source.append(j)
-                    cuu_target.append(k)
-                    edge_type.append(2)
-                    edge_time.append(2)
-
-            for j in range(utt_feature.shape[1], 2 * utt_feature.shape[1]):
-                s = 3 * utt_feature.shape[1] + comet_feature.shape[-2] * (
-                    j - utt_feature.shape[1]
-                )
-                for k in range(s, s + comet_feature.shape[-2]):
-                    cuu_source.append(k)
-                    cuu_target.append(j)
-                    edge_type.append(3)
-                    edge_time.append(0)
-
-                    cuu_source.append(k)
-                    cuu_target.append(j + utt_feature.shape[1])
-                    edge_type.append(3)
-                    edge_time.append(0)
-
-            edge_index[0] += [
-                j + i * int(node_feature.shape[0] / utt_feature.shape[0])
-                for j in cuu_source
-            ]
-            edge_index[1] += [
-                j + i * int(node_feature.shape[0] / utt_feature.shape[0])
-                for j in cuu_target
-            ]
-        edge_index = torch.LongTensor(edge_index)
-        edge_type = torch.LongTensor(edge_type)
-        edge_time = torch.LongTensor(edge_time)
 
         return (
             node_feature.to(self.device),
@@ -1352,10 +1532,12 @@ class GraphERC(nn.Module):
         attn_weights = torch.matmul(K, Q.unsqueeze(-1)).squeeze(-1) / torch.sqrt(
             torch.tensor(Q.shape[-1])
         )
+        # -100000.0 overflows float16, so mask and normalize in float32.
+        attn_weights = attn_weights.float()
         if mask is not None:
             mask = (1.0 - mask) * -100000.0
             attn_weights = attn_weights + mask
-        attn_weights = torch.softmax(attn_weights, dim=-1)
+        attn_weights = torch.softmax(attn_weights, dim=-1).to(V.dtype)
         return torch.matmul(attn_weights.unsqueeze(-2), V).squeeze(-2)
 
     def compute_latent_params(self, context, layer, mode="train"):
@@ -1 +1,9 @@
 from .utils import *
+from .collate import (
+    ErcCollator,
+    DialogueCollator,
+    RecconCollator,
+    LengthBucketBatchSampler,
+    DialogueBatchSampler,
+    batch_to_device,
+)
@@ -0,0 +1,183 @@
+"""On-disk cache of preprocessed dataset samples."""
+import os
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+import torch
+
+# Bump whenever the layout of a cached sample changes.
+CACHE_VERSION = 5
+
+
+def dataset_cache_key(**config) -> str:
+    """Hash the preprocessing config that determines the built samples."""
+    config = dict(config, CACHE_VERSION=CACHE_VERSION)
+    blob = json.dumps(config, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha1(blob).hexdigest()[:16]
+
+
+def file_fingerprint(path):
+    """The path, size and modification time of a source file of the samples, so
+    that regenerated or edited data never hits the cache of the old files."""
+    if not os.path.exists(path):
+        return [os.path.abspath(path), None, None]
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def _concat_ragged(lists):
+    """Flatten a list of int lists into (values, offsets)."""
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(item) for item in lists])
+    values = np.fromiter(
+        (v for item in lists for v in item), dtype=np.int32, count=int(offsets[-1])
+    )
+    return values, offsets
+
+
+def _features_to_numpy(features):
+    """numpy has no bfloat16, so bfloat16 features are stored as their raw bits."""
+    if features.dtype == torch.bfloat16:
+        return features.view(torch.int16).numpy()
+    return features.numpy()
+
+
+def _features_from_numpy(array, dtype):
+    features = torch.from_numpy(array)
+    if dtype == str(torch.bfloat16):
+        return features.view(torch.bfloat16)
+    return features
+
+
+def save_erc_cache(path, inputs, num_truncated, comet_bank, chunk_bank, config):
+    """Write ErcTextDataset samples and their feature and chunk banks to `path`."""
+    tmp_path = "{}.tmp-{}".format(path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+
+    input_ids, input_offsets = _concat_ragged([item["input_ids"] for item in inputs])
+    target_ids, target_offsets = _concat_ragged(
+        [item["target utterance"]["ids"] for item in inputs]
+    )
+    pos_spans = np.array([item["pos_spans"] for item in inputs], dtype=np.int32)
+    chunk_ids, chunk_offsets = _concat_ragged(chunk_bank.chunk_ids)
+    arrays = {
+        "input_ids": input_ids,
+        "input_offsets": input_offsets,
+        "target_ids": target_ids,
+        "target_offsets": target_offsets,
+        "pos_spans": pos_spans,
+        "comet_bank": _features_to_numpy(comet_bank.features),
+        "dialogue_starts": comet_bank.dialogue_starts.numpy(),
+        "chunk_ids": chunk_ids,
+        "chunk_offsets": chunk_offsets,
+        "dialogue_chunk_starts": chunk_bank.dialogue_chunk_starts,
+        "utterance_spans": chunk_bank.utterance_spans,
+        "utterance_dialogue_starts": chunk_bank.dialogue_starts,
+        "comet_dialogues": np.array(
+            [item["comet_features"]["dialogue"] for item in inputs], dtype=np.int64
+        ),
+        "comet_offsets": np.array(
+            [item["comet_features"]["offset"] for item in inputs], dtype=np.int64
+        ),
+        "comet_masks": torch.stack(
+            [item["comet_features"]["mask"] for item in inputs], dim=0
+        ).numpy(),
+        "comet_sent_labels": np.array(
+            [item["comet_features"]["comet_sent_labels"] for item in inputs],
+            dtype=np.int64,
+        ),
+        "labels": np.array([item["label"] for item in inputs], dtype=np.int64),
+    }
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + ".npy"), array)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "version": CACHE_VERSION,
+                "config": config,
+                "num_samples": len(inputs),
+                "num_truncated": num_truncated,
+                "comet_bank_dtype": str(comet_bank.features.dtype),
+            },
+            f,
+            default=str,
+        )
+
+    # Publish the finished directory in one step so that concurrent runs never
+    # observe a half-written cache.
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    logging.info(f"saved {len(inputs)} samples to cache {path}")
+
+
+def load_erc_cache(path):
+    """Load ErcTextDataset samples from `path`, or return None on a cache miss.
+
+    Returns the samples, the number of truncated contexts, the features and
+    dialogue starts of the CometFeatureBank, and the arguments of the
+    DialogueChunkBank. The features are memory-mapped, so they are only paged
+    in when a batch gathers them.
+    """
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, "r") as f:
+        meta = json.load(f)
+    if meta["version"] != CACHE_VERSION:
+        return None
+
+    def _load(name):
+        # Copy-on-write mapping keeps the arrays writable for torch.from_numpy
+        # without ever touching the file on disk.
+        return np.load(os.path.join(path, name + ".npy"), mmap_mode="c")
+
+    input_ids, input_offsets = _load("input_ids"), _load("input_offsets")
+    target_ids, target_offsets = _load("target_ids"), _load("target_offsets")
+    pos_spans = _load("pos_spans")
+    comet_dialogues = _load("comet_dialogues")
+    comet_offsets = _load("comet_offsets")
+    comet_masks = _load("comet_masks")
+    comet_sent_labels = _load("comet_sent_labels")
+    labels = _load("labels")
+
+    inputs = []
+    for i in range(meta["num_samples"]):
+        ids = input_ids[input_offsets[i] : input_offsets[i + 1]].tolist()
+        cuu_ids = target_ids[target_offsets[i] : target_offsets[i + 1]].tolist()
+        inputs.append(
+            {
+                "input_ids": ids,
+                "attention_mask": [1] * len(ids),
+                "pos_spans": pos_spans[i].tolist(),
+                "comet_features": {
+                    "dialogue": int(comet_dialogues[i]),
+                    "offset": int(comet_offsets[i]),
+                    "mask": torch.from_numpy(comet_masks[i]),
+                    "comet_sent_labels": comet_sent_labels[i].tolist(),
+                },
+                "label": int(labels[i]),
+                "target utterance": {"ids": cuu_ids, "masks": [1] * len(cuu_ids)},
+            }
+        )
+    chunk_ids, chunk_offsets = _load("chunk_ids"), _load("chunk_offsets")
+    chunks = (
+        [
+            chunk_ids[chunk_offsets[i] : chunk_offsets[i + 1]].tolist()
+            for i in range(len(chunk_offsets) - 1)
+        ],
+        _load("dialogue_chunk_starts"),
+        _load("utterance_spans"),
+        _load("utterance_dialogue_starts"),
+    )
+    logging.info(f"loaded {len(inputs)} samples from cache {path}")
+    return (
+        inputs,
+        meta["num_truncated"],
+        _features_from_numpy(_load("comet_bank"), meta["comet_bank_dtype"]),
+        _load("dialogue_starts"),
+        chunks,
+    )
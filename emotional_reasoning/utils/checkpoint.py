@@ -0,0 +1,230 @@
+"""Resumable training checkpoints written from a background thread."""
+import os
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+import numpy as np
+import torch
+
+INDEX_NAME = "checkpoints.json"
+
+
+def _to_cpu(obj):
+    """Copy every tensor of a (nested) state dict to the host.
+
+    The copies are taken before the next training step updates the parameters
+    and optimizer state in place.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: _to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return obj
+
+
+def get_rng_state():
+    """Snapshot the python, numpy and torch random generators."""
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def load_model_state(path, map_location="cpu"):
+    """Load the model weights from a checkpoint or a plain state dict file."""
+    state = torch.load(path, map_location=map_location)
+    if "model" in state and "optimizer" in state:
+        return state["model"]
+    return state
+
+
+class CheckpointManager:
+    """Save full training checkpoints and keep only the best ones.
+
+    A checkpoint holds the model, optimizer, scheduler, grad scaler and RNG
+    states of one epoch. The states are copied to the host on the calling
+    thread and written to disk by a background thread. After each write, only
+    the `keep_top_k` checkpoints with the highest dev score and the latest one,
+    which --resume continues from, are kept. `checkpoints.json` indexes the kept
+    files.
+    """
+
+    def __init__(self, save_dir, keep_top_k=1, resume=False):
+        """
+        :param save_dir: The directory the checkpoints are written to.
+        :param keep_top_k: The number of best checkpoints to keep.
+        :param resume: Continue from the checkpoints indexed in save_dir. A new
+            run starts from an empty index instead; see clear.
+        """
+        self.save_dir = save_dir
+        self.keep_top_k = keep_top_k
+        if resume:
+            self.index = self._read_index()
+        else:
+            self.index = {"checkpoints": [], "last": None}
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write_checkpoints, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def clear(self):
+        """Delete the checkpoints and index an earlier run left in save_dir.
+
+        Otherwise they would be ranked against, and could prune, the
+        checkpoints of a new run. Only the process that writes the
+        checkpoints should call this.
+        """
+        for name in os.listdir(self.save_dir):
+            if name == INDEX_NAME or (
+                name.startswith("checkpoint_") and name.endswith(".pth")
+            ):
+                os.remove(os.path.join(self.save_dir, name))
+        self.index = {"checkpoints": [], "last": None}
+
+    def _read_index(self):
+        path = os.path.join(self.save_dir, INDEX_NAME)
+        if not os.path.exists(path):
+            return {"checkpoints": [], "last": None}
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def _write_index(self):
+        path = os.path.join(self.save_dir, INDEX_NAME)
+        tmp_path = "{}.tmp-{}".format(path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def save(self, epoch, score, model, optimizer, scheduler, scaler, **extra):
+        """Queue the checkpoint of `epoch`, ranked by the dev `score`.
+
+        :param extra: Any other JSON-serializable training state to restore.
+        """
+        state = _to_cpu(
+            {
+                "epoch": epoch,
+                "score": score,
+                "model": model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "scheduler": scheduler.state_dict(),
+                "scaler": scaler.state_dict(),
+                "rng": get_rng_state(),
+                "extra": extra,
+            }
+        )
+        self.queue.put(state)
+
+    def best(self):
+        """Return the epoch, score and path of the best checkpoint, or None.
+
+        Waits for the queued writes, and reads the index from disk so that
+        processes which did not write the checkpoints see them too.
+        """
+        self.queue.join()
+        self.index = self._read_index()
+        if not self.index["checkpoints"]:
+            return None
+        return self.index["checkpoints"][0]
+
+    def load_last(self, model, optimizer, scheduler, scaler):
+        """Restore the latest checkpoint and return its state, or None if absent."""
+        if self.index["last"] is None:
+            return None
+        state = torch.load(self.index["last"], map_location="cpu")
+        model.load_state_dict(state["model"])
+        optimizer.load_state_dict(state["optimizer"])
+        scheduler.load_state_dict(state["scheduler"])
+        scaler.load_state_dict(state["scaler"])
+        set_rng_state(state["rng"])
+        logging.info(f"resumed from checkpoint {self.index['last']}")
+        return state
+
+    def close(self):
+        """Write the queued checkpoints and stop the writer thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _write_checkpoints(self):
+        while True:
+            state = self.queue.get()
+            if state is None:
+                self.queue.task_done()
+                return
+            try:
+                self._write(state)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, state):
+        path = os.path.join(self.save_dir, "checkpoint_{}.pth".format(state["epoch"]))
+        tmp_path = "{}.tmp-{}".format(path, os.getpid())
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+
+        checkpoints = [
+            item for item in self.index["checkpoints"] if item["path"] != path
+        ]
+        checkpoints.append(
+            {"epoch": state["epoch"], "score": state["score"], "path": path}
+        )
+        checkpoints.sort(key=lambda item: item["score"], reverse=True)
+        kept, dropped = checkpoints[: self.keep_top_k], checkpoints[self.keep_top_k :]
+        previous_last = self.index["last"]
+        self.index = {"checkpoints": kept, "last": path}
+        self._write_index()
+
+        kept_paths = {item["path"] for item in kept} | {path}
+        for stale in [item["path"] for item in dropped] + [previous_last]:
+            if stale is not None and stale not in kept_paths:
+                if os.path.exists(stale):
+                    os.remove(stale)
+        logging.info(f"saved checkpoint {path}")
+
+
+class EarlyStopping:
+    """Stop training once the dev score has not improved for `patience` epochs."""
+
+    def __init__(self, patience, best_score=None, num_bad_epochs=0):
+        """
+        :param patience: The number of epochs without improvement to tolerate.
+            0 never stops.
+        :param best_score: The best dev score so far, when resuming.
+        :param num_bad_epochs: The epochs since best_score, when resuming.
+        """
+        self.patience = patience
+        self.best_score = best_score
+        self.num_bad_epochs = num_bad_epochs
+
+    def step(self, score):
+        """Record the dev score of an epoch and return whether it is the best."""
+        if self.best_score is None or score > self.best_score:
+            self.best_score = score
+            self.num_bad_epochs = 0
+            return True
+        self.num_bad_epochs += 1
+        return False
+
+    @property
+    def should_stop(self):
+        return self.patience > 0 and self.num_bad_epochs >= self.patience
+
+    def state_dict(self):
+        return {"best_score": self.best_score, "num_bad_epochs": self.num_bad_epochs}
@@ -0,0 +1,201 @@
+"""Batch assembly for the DataLoader pipeline."""
+import math
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+
+class ErcCollator:
+    """Pad a list of ErcTextDataset samples into one batch of tensors."""
+
+    def __init__(self, comet_bank, pad_token_id=1):
+        """
+        :param comet_bank: The CometFeatureBank of the dataset the samples come from.
+        :param pad_token_id: The token id used to pad input_ids.
+        """
+        self.comet_bank = comet_bank
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, samples):
+        input_ids = pad_sequence(
+            [torch.LongTensor(item["input_ids"]) for item in samples],
+            batch_first=True,
+            padding_value=self.pad_token_id,
+        )
+        attention_mask = pad_sequence(
+            [torch.LongTensor(item["attention_mask"]) for item in samples],
+            batch_first=True,
+            padding_value=0,
+        )
+        # [WIN, B, 2] token spans, expanded into position masks by the model.
+        utt_pos_spans = torch.LongTensor([item["pos_spans"] for item in samples])
+        utt_pos_spans = utt_pos_spans.transpose(0, 1).contiguous()
+        comet_features, comet_masks = self.comet_bank.gather(
+            [item["comet_features"] for item in samples]
+        )
+        labels = torch.LongTensor([item["label"] for item in samples])
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "utt_pos_spans": utt_pos_spans,
+            "comet_features": comet_features,
+            "comet_masks": comet_masks,
+            "labels": labels,
+        }
+
+
+class DialogueCollator:
+    """Batch the targets of whole dialogues around one shared encoder pass.
+
+    Instead of one context per target, the batch holds the encoder chunks of
+    every dialogue in it once, together with the [chunk, start, end) spans of
+    their utterances and the rows of these utterances that form the window of
+    each target.
+    """
+
+    def __init__(self, comet_bank, chunk_bank, pad_token_id=1):
+        """
+        :param comet_bank: The CometFeatureBank of the dataset the samples come from.
+        :param chunk_bank: The DialogueChunkBank of the same dataset.
+        :param pad_token_id: The token id used to pad input_ids.
+        """
+        self.comet_bank = comet_bank
+        self.chunk_bank = chunk_bank
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, samples):
+        comet_items = [item["comet_features"] for item in samples]
+        dialogues = list(dict.fromkeys(item["dialogue"] for item in comet_items))
+        chunk_ids, utterance_spans, utterance_starts = self.chunk_bank.gather(
+            dialogues
+        )
+        input_ids = pad_sequence(
+            [torch.LongTensor(ids) for ids in chunk_ids],
+            batch_first=True,
+            padding_value=self.pad_token_id,
+        )
+        attention_mask = pad_sequence(
+            [torch.ones(len(ids), dtype=torch.long) for ids in chunk_ids],
+            batch_first=True,
+            padding_value=0,
+        )
+        comet_features, comet_masks = self.comet_bank.gather(comet_items)
+
+        # Window slot w of a target holds utterance offset - COMET_WIN_SIZE + w of
+        # its dialogue; masked slots point to row -1.
+        utterance_starts = dict(zip(dialogues, utterance_starts))
+        rows = torch.LongTensor(
+            [
+                utterance_starts[item["dialogue"]]
+                + item["offset"]
+                - self.comet_bank.COMET_WIN_SIZE
+                for item in comet_items
+            ]
+        )
+        rows = rows.unsqueeze(1) + torch.arange(comet_masks.shape[1]).unsqueeze(0)
+        rows = torch.where(comet_masks != 0, rows, torch.full_like(rows, -1))
+        labels = torch.LongTensor([item["label"] for item in samples])
+        return {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "utt_pos_spans": utterance_spans,
+            "window_rows": rows.transpose(0, 1).contiguous(),
+            "comet_features": comet_features,
+            "comet_masks": comet_masks,
+            "labels": labels,
+        }
+
+
+class RecconCollator:
+    """Turn one RECCONTextDataset dialogue into a batch of tensors.
+
+    CasualVIBERC encodes a single dialogue per step, so the loader must use a
+    batch size of 1.
+    """
+
+    def __call__(self, samples):
+        (sample,) = samples
+        return {
+            "input_ids": torch.LongTensor(sample["input_ids"]),
+            "attention_mask": torch.LongTensor(sample["attention_mask"]),
+            "pos_masks": sample["pos_masks"],
+            "comet_features": sample["comet_features"],
+            "labels": torch.FloatTensor(sample["label"]),
+            "emolabels": torch.LongTensor(sample["emolabel"]),
+        }
+
+
+class LengthBucketBatchSampler(torch.utils.data.Sampler):
+    """Batch samples of similar length to cut the padding of each batch.
+
+    Every epoch the indexes are shuffled and split into buckets of
+    `bucket_size` batches. Each bucket is sorted by length and cut into
+    batches, and the batches of all buckets are shuffled again, so the
+    composition and order of the batches still change between epochs.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size=100, shuffle=True):
+        """
+        :param lengths: The number of tokens of every sample.
+        :param batch_size: The number of samples per batch.
+        :param bucket_size: The number of batches sorted together.
+        :param shuffle: Whether to randomize the buckets and batches every epoch.
+        """
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        if self.shuffle:
+            indexes = torch.randperm(len(self.lengths))
+        else:
+            indexes = torch.arange(len(self.lengths))
+        batches = []
+        for bucket in indexes.split(self.batch_size * self.bucket_size):
+            # A stable sort keeps the random order among samples of equal length.
+            order = torch.sort(self.lengths[bucket], stable=True)[1]
+            batches += bucket[order].split(self.batch_size)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches))]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+
+class DialogueBatchSampler(torch.utils.data.Sampler):
+    """Batch all targets of `batch_size` dialogues together."""
+
+    def __init__(self, dialogues, batch_size, shuffle=True):
+        """
+        :param dialogues: The dialogue id of every sample.
+        :param batch_size: The number of dialogues per batch.
+        :param shuffle: Whether to shuffle the dialogues every epoch.
+        """
+        groups = {}
+        for index, dialogue in enumerate(dialogues):
+            groups.setdefault(dialogue, []).append(index)
+        self.groups = list(groups.values())
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.groups)).tolist()
+        else:
+            order = list(range(len(self.groups)))
+        for i in range(0, len(order), self.batch_size):
+            yield [
+                index
+                for group in order[i : i + self.batch_size]
+                for index in self.groups[group]
+            ]
+
+    def __len__(self):
+        return math.ceil(len(self.groups) / self.batch_size)
+
+
+def batch_to_device(batch, device):
+    """Move a collated batch to `device`; pinned tensors are copied asynchronously."""
+    return {key: value.to(device, non_blocking=True) for key, value in batch.items()}
@@ -0,0 +1,89 @@
+"""Multi-process data parallel training under torchrun."""
+import os
+import math
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(cuda):
+    """Join the process group that torchrun set up, if any.
+
+    NCCL is used between GPUs and gloo between CPU processes. Returns the rank,
+    the local rank and the world size; (0, 0, 1) when not launched by torchrun.
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        return 0, 0, 1
+    local_rank = int(os.environ["LOCAL_RANK"])
+    if cuda:
+        torch.cuda.set_device(local_rank)
+    dist.init_process_group(backend="nccl" if cuda else "gloo")
+    return dist.get_rank(), local_rank, world_size
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main_process():
+    """Only the first process logs, prints and writes checkpoints."""
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce_sum(value, device):
+    """Sum a tensor or a number over all processes and return a tensor."""
+    value = torch.as_tensor(value, device=device)
+    if is_distributed():
+        value = value.clone()
+        dist.all_reduce(value, op=dist.ReduceOp.SUM)
+    return value
+
+
+class DistributedBatchSampler(torch.utils.data.Sampler):
+    """Give every process its own share of the batches of a batch sampler.
+
+    Each epoch, all processes draw the batches of the wrapped sampler from the
+    same seed, so they agree on the batches, and process r keeps batches
+    r, r + world_size, ... When `pad` is set, batches are repeated so that all
+    processes take the same number of steps, as the gradient all-reduce of
+    training needs; evaluation leaves the last shares uneven to count every
+    sample exactly once.
+    """
+
+    def __init__(self, batch_sampler, num_replicas, rank, seed=0, pad=True):
+        """
+        :param batch_sampler: The sampler yielding the batches of the whole dataset.
+        :param num_replicas: The number of processes.
+        :param rank: The rank of this process.
+        :param seed: The seed the batches of every epoch are drawn from.
+        :param pad: Whether to even out the number of batches of the processes.
+        """
+        self.batch_sampler = batch_sampler
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.pad = pad
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(self.seed + self.epoch)
+            batches = list(self.batch_sampler)
+        if self.pad and len(batches) % self.num_replicas != 0:
+            num_padded = self.num_replicas - len(batches) % self.num_replicas
+            batches += [batches[i % len(batches)] for i in range(num_padded)]
+        return iter(batches[self.rank :: self.num_replicas])
+
+    def __len__(self):
+        num_batches = len(self.batch_sampler)
+        if self.pad:
+            return math.ceil(num_batches / self.num_replicas)
+        return len(range(self.rank, num_batches, self.num_replicas))
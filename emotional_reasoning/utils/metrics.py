@@ -0,0 +1,192 @@
+"""Stores for the metrics and diagnostics of train/dev/test passes."""
+import json
+import queue
+import atexit
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+import torch
+
+try:
+    import fcntl
+except ImportError:
+    # Not available outside POSIX; rows are then appended without a lock,
+    # which is safe as long as a single process writes the file.
+    fcntl = None
+
+RESULT_COLUMNS = [
+    "epochs",
+    "mode",
+    "avg_loss",
+    "weighted_f1",
+    "micro_f1",
+    "macro_f1",
+    "dataset",
+    "experiment",
+    "params",
+]
+
+
+class MetricsSink:
+    """Append metric rows to a JSONL file from a background thread.
+
+    Every row is written as one line under an exclusive file lock (where fcntl
+    is available), so runs that share a results file never interleave or drop
+    rows, and logging never blocks the training loop on disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write_rows, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def log(self, row):
+        """Queue one row (a dict of JSON-serializable values) for writing."""
+        self.queue.put(row)
+
+    def close(self):
+        """Write the queued rows and stop the writer thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _write_rows(self):
+        while True:
+            row = self.queue.get()
+            if row is None:
+                return
+            line = json.dumps(row, default=str) + "\n"
+            with open(self.path, "a") as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.write(line)
+                    f.flush()
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _safe_divide(numerator, denominator):
+    """Divide, with 0 where the denominator is 0 like sklearn's zero_division."""
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    return np.divide(
+        numerator,
+        denominator,
+        out=np.zeros_like(numerator),
+        where=denominator != 0,
+    )
+
+
+class ConfusionMatrix:
+    """Accumulate the confusion matrix of a pass on device, one batch at a time.
+
+    All metrics are derived from the matrix at the end of the pass, so the
+    labels and predictions never leave the device during the loop.
+    """
+
+    def __init__(self, num_classes, device=None):
+        self.num_classes = num_classes
+        self.matrix = torch.zeros(
+            [num_classes, num_classes], dtype=torch.long, device=device
+        )
+
+    def update(self, labels, predicts):
+        """
+        :param labels: The ground-truth classes of a batch. Dim: [B]
+        :param predicts: The predicted classes of the batch. Dim: [B]
+        """
+        index = labels.long() * self.num_classes + predicts.long()
+        self.matrix += torch.bincount(
+            index.flatten(), minlength=self.num_classes ** 2
+        ).view(self.num_classes, self.num_classes)
+
+    def compute(self, labels=None):
+        """
+        :param labels: The classes the F1 scores are computed over, like the
+            labels argument of sklearn's f1_score. Defaults to every class that
+            occurs in the ground truth or the predictions.
+        :return: The accuracy, the weighted, micro and macro F1, and the F1 of
+            each class in `labels`.
+        """
+        matrix = self.matrix.cpu().numpy()
+        tp = np.diag(matrix)
+        num_true = matrix.sum(axis=1)
+        num_pred = matrix.sum(axis=0)
+        if labels is None:
+            labels = np.flatnonzero(num_true + num_pred)
+        labels = np.asarray(list(labels), dtype=np.int64)
+        tp, num_true, num_pred = tp[labels], num_true[labels], num_pred[labels]
+
+        per_class_f1 = _safe_divide(2 * tp, num_true + num_pred)
+        return {
+            "accuracy": float(_safe_divide(np.trace(matrix), matrix.sum())),
+            "weighted_f1": float(
+                _safe_divide((per_class_f1 * num_true).sum(), num_true.sum())
+            ),
+            "micro_f1": float(
+                _safe_divide(2 * tp.sum(), num_true.sum() + num_pred.sum())
+            ),
+            "macro_f1": float(per_class_f1.mean()) if len(labels) else 0.0,
+            "per_class_f1": per_class_f1,
+        }
+
+
+class SimilarityWriter:
+    """Stream per-sample similarity rows into a memory-mapped .npy file."""
+
+    def __init__(self, path, num_rows):
+        """
+        :param path: The .npy file to write.
+        :param num_rows: The number of samples of the pass.
+        """
+        self.path = path
+        self.num_rows = num_rows
+        self.array = None
+        self.row = 0
+
+    def write(self, similarity):
+        """
+        :param similarity: The similarities of a batch. Dim: [B, K]
+        """
+        similarity = similarity.float().cpu().numpy()
+        if self.array is None:
+            self.array = np.lib.format.open_memmap(
+                self.path,
+                mode="w+",
+                dtype=np.float32,
+                shape=(self.num_rows, similarity.shape[1]),
+            )
+        self.array[self.row : self.row + len(similarity)] = similarity
+        self.row += len(similarity)
+
+    def close(self):
+        if self.array is not None:
+            self.array.flush()
+            self.array = None
+
+
+def load_metrics(path):
+    """Read the rows of a results file into a DataFrame."""
+    with open(path, "r") as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    return pd.DataFrame(rows, columns=RESULT_COLUMNS)
+
+
+def export_metrics(path, output_path):
+    """Write the rows of a results file to a spreadsheet."""
+    load_metrics(path).to_excel(output_path, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export the logged train/dev/test metrics to a spreadsheet."
+    )
+    parser.add_argument("--results", default="results.jsonl")
+    parser.add_argument("--output", default="result.xlsx")
+    args = parser.parse_args()
+    export_metrics(args.results, args.output)
@@ -4,13 +4,21 @@ import json
 import pickle
 import os
 import copy
+import math
 import logging
+import multiprocessing
 from tqdm import tqdm
 from sklearn.metrics import f1_score
 import numpy as np
 import random
 from transformers import AutoTokenizer
 from torch.nn.utils.rnn import pad_sequence
+from .cache import (
+    dataset_cache_key,
+    file_fingerprint,
+    save_erc_cache,
+    load_erc_cache,
+)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -237,6 +245,206 @@ def get_emotion2id(DATASET: str) -> dict:
     return emotion2id[DATASET]
 
 
+FEATURE_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16,
+}
+
+
+def get_feature_dtype(FEATURE_DTYPE: str) -> torch.dtype:
+    """Get the torch dtype the knowledge features are stored in."""
+    if FEATURE_DTYPE not in FEATURE_DTYPES:
+        raise ValueError(f"{FEATURE_DTYPE} not supported!!!!!!")
+    return FEATURE_DTYPES[FEATURE_DTYPE]
+
+
+# Per-process state of the dataset preprocessing workers.
+_preprocess_dataset = None
+_preprocess_tokenizer = None
+
+
+def _load_tokenizer(model_checkpoint):
+    return AutoTokenizer.from_pretrained(model_checkpoint, use_fast=True)
+
+
+def _build_dialogues(dataset, tokenizer, dialogues, first_id=0):
+    inputs = []
+    num_truncated = 0
+    dialogue_data = []
+    for dialogue_id, dialogue in enumerate(dialogues, first_id):
+        dialogue_inputs, dialogue_truncated, data = dataset._build_dialogue(
+            dialogue_id, dialogue, tokenizer
+        )
+        inputs += dialogue_inputs
+        num_truncated += dialogue_truncated
+        dialogue_data.append(data)
+    return inputs, num_truncated, dialogue_data
+
+
+def _init_preprocess_worker(dataset):
+    global _preprocess_dataset, _preprocess_tokenizer
+    # The workers already run in parallel, so keep each tokenizer single-threaded.
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _preprocess_dataset = dataset
+    _preprocess_tokenizer = _load_tokenizer(dataset.model_checkpoint)
+
+
+def _build_shard(shard):
+    first_id, dialogues = shard
+    result = _build_dialogues(
+        _preprocess_dataset, _preprocess_tokenizer, dialogues, first_id
+    )
+    # Plain pickling keeps the tensors out of torch's shared-memory transport,
+    # which would otherwise hold one file descriptor per tensor.
+    return pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def build_samples(dataset, dialogues, num_workers=1):
+    """Build the samples of `dataset` from its raw dialogues.
+
+    Returns the samples, the number of truncated contexts and the per-dialogue
+    data shared by the samples of each dialogue (or None). With more than one
+    worker, the dialogues are split into contiguous shards
+    that are built in a process pool, each process loading its own tokenizer.
+    The shards are merged back in order, so the result does not depend on
+    the number of workers.
+    """
+    if num_workers <= 1 or len(dialogues) <= 1:
+        tokenizer = _load_tokenizer(dataset.model_checkpoint)
+        return _build_dialogues(dataset, tokenizer, dialogues)
+
+    # A few shards per worker balances dialogues of very different lengths.
+    shard_size = math.ceil(len(dialogues) / (4 * num_workers))
+    shards = [
+        (i, dialogues[i : i + shard_size])
+        for i in range(0, len(dialogues), shard_size)
+    ]
+    inputs = []
+    num_truncated = 0
+    dialogue_data = []
+    with multiprocessing.Pool(
+        num_workers, initializer=_init_preprocess_worker, initargs=(dataset,)
+    ) as pool:
+        for result in pool.imap(_build_shard, shards):
+            shard_inputs, shard_truncated, shard_data = pickle.loads(result)
+            inputs += shard_inputs
+            num_truncated += shard_truncated
+            dialogue_data += shard_data
+    return inputs, num_truncated, dialogue_data
+
+
+class CometFeatureBank:
+    """The COMET features of every utterance in a split, stored once.
+
+    Samples refer to their knowledge window by dialogue id and target offset,
+    and the [B, WIN, K, D] windows are gathered per batch, so the memory of the
+    features grows with the number of utterances instead of utterances times
+    window size.
+    """
+
+    def __init__(self, features, dialogue_starts, COMET_WIN_SIZE):
+        """
+        :param features: The features of all utterances. Dim: [U, K, D]
+        :param dialogue_starts: The row of the first utterance of each dialogue.
+        :param COMET_WIN_SIZE: The number of window slots before the target.
+        """
+        self.features = features
+        self.dialogue_starts = torch.as_tensor(dialogue_starts, dtype=torch.long)
+        self.COMET_WIN_SIZE = COMET_WIN_SIZE
+
+    @classmethod
+    def from_dialogues(cls, dialogue_features, COMET_WIN_SIZE):
+        """Concatenate per-dialogue [N, K, D] features; None marks an empty dialogue."""
+        lengths = [0 if f is None else f.shape[0] for f in dialogue_features]
+        dialogue_starts = np.cumsum([0] + lengths[:-1])
+        features = torch.cat([f for f in dialogue_features if f is not None], dim=0)
+        return cls(features, dialogue_starts, COMET_WIN_SIZE)
+
+    def gather(self, comet_items):
+        """
+        :param comet_items: The "comet_features" entries of a batch of samples.
+        :return: The knowledge windows [B, WIN, K, D] and their masks [B, WIN].
+        """
+        masks = torch.stack([item["mask"] for item in comet_items], dim=0)
+        dialogues = torch.LongTensor([item["dialogue"] for item in comet_items])
+        offsets = torch.LongTensor([item["offset"] for item in comet_items])
+        rows = self.dialogue_starts[dialogues] + offsets - self.COMET_WIN_SIZE
+        rows = rows.unsqueeze(1) + torch.arange(masks.shape[1]).unsqueeze(0)
+        valid = masks != 0
+        # Masked slots may point outside the dialogue, so read row 0 and zero it.
+        rows = torch.where(valid, rows, torch.zeros_like(rows))
+        features = self.features[rows].masked_fill(~valid[:, :, None, None], 0.0)
+        return features, masks
+
+
+class DialogueChunkBank:
+    """The token ids of every dialogue in a split, cut into encoder-sized chunks.
+
+    Each dialogue is split at utterance boundaries into chunks that fit the
+    encoder, so that it can be encoded once and shared by the windows of all
+    its targets. Utterance rows line up with the rows of the CometFeatureBank.
+    """
+
+    def __init__(
+        self, chunk_ids, dialogue_chunk_starts, utterance_spans, dialogue_starts
+    ):
+        """
+        :param chunk_ids: The input_ids of every chunk.
+        :param dialogue_chunk_starts: The first chunk of each dialogue, followed
+            by the total number of chunks.
+        :param utterance_spans: The chunk within its dialogue and the [start, end)
+            token span of every utterance. Dim: [U, 3]
+        :param dialogue_starts: The row of the first utterance of each dialogue,
+            followed by the total number of utterances.
+        """
+        self.chunk_ids = chunk_ids
+        self.dialogue_chunk_starts = np.asarray(dialogue_chunk_starts)
+        self.utterance_spans = np.asarray(utterance_spans).reshape(-1, 3)
+        self.dialogue_starts = np.asarray(dialogue_starts)
+
+    @classmethod
+    def from_dialogues(cls, dialogue_chunks):
+        """Concatenate per-dialogue (chunk ids, spans); None marks an empty dialogue."""
+        chunk_ids = []
+        chunk_lengths = []
+        utterance_spans = []
+        for chunks in dialogue_chunks:
+            ids, spans = chunks if chunks is not None else ([], [])
+            chunk_ids += ids
+            chunk_lengths.append(len(ids))
+            utterance_spans.append(np.asarray(spans, dtype=np.int64).reshape(-1, 3))
+        return cls(
+            chunk_ids,
+            np.cumsum([0] + chunk_lengths),
+            np.concatenate(utterance_spans, axis=0),
+            np.cumsum([0] + [len(spans) for spans in utterance_spans]),
+        )
+
+    def gather(self, dialogues):
+        """
+        :param dialogues: The ids of the dialogues in a batch.
+        :return: The input_ids of their chunks, the [chunk, start, end] spans of
+            their utterances with the chunks numbered within the batch, and the
+            row of the first utterance of each dialogue among these spans.
+        """
+        chunk_ids = []
+        utterance_spans = []
+        utterance_starts = []
+        num_utterances = 0
+        for dialogue in dialogues:
+            first, last = self.dialogue_starts[dialogue : dialogue + 2]
+            spans = self.utterance_spans[first:last].copy()
+            spans[:, 0] += len(chunk_ids)
+            first, last = self.dialogue_chunk_starts[dialogue : dialogue + 2]
+            chunk_ids += self.chunk_ids[first:last]
+            utterance_spans.append(spans)
+            utterance_starts.append(num_utterances)
+            num_utterances += len(spans)
+        utterance_spans = torch.from_numpy(np.concatenate(utterance_spans, axis=0))
+        return chunk_ids, utterance_spans.long(), utterance_starts
+
+
 class ErcTextDataset(torch.utils.data.Dataset):
     def __init__(
         self,
@@ -250,6 +458,11 @@ class ErcTextDataset(torch.utils.data.Dataset):
         ONLY_UPTO=False,
         SEED=0,
         COMET_WIN_SIZE=5,
+        FEATURE_DTYPE="float32",
+        CHUNK_STRIDE=0,
+        CACHE_DIR=None,
+        tokenize_once=False,
+        num_preprocess_workers=1,
     ):
         """Initialize emotion recognition in conversation text modality dataset class."""
 
@@ -264,6 +477,14 @@ class ErcTextDataset(torch.utils.data.Dataset):
         self.ONLY_UPTO = ONLY_UPTO
         self.SEED = SEED
         self.COMET_WIN_SIZE = COMET_WIN_SIZE
+        self.FEATURE_DTYPE = FEATURE_DTYPE
+        # The knowledge features are kept in this dtype and only converted to the
+        # compute dtype once a batch is on the device.
+        self.feature_dtype = get_feature_dtype(FEATURE_DTYPE)
+        self.CHUNK_STRIDE = CHUNK_STRIDE
+        self.CACHE_DIR = CACHE_DIR
+        self.tokenize_once = tokenize_once
+        self.num_preprocess_workers = num_preprocess_workers
         self.comet_index = torch.LongTensor([i for i in range(7)])
         self.conceptnet_max_num = 20
         if "roberta" in model_checkpoint:
@@ -272,7 +493,58 @@ class ErcTextDataset(torch.utils.data.Dataset):
             self.sep_token = "[SEP]"
 
         set_seed(self.SEED)
-        self._load_data()
+        if not self._load_cache():
+            self._load_data()
+            self._save_cache()
+
+    def _cache_config(self):
+        """The preprocessing settings that determine the built samples."""
+        return {
+            "DATASET": self.DATASET,
+            "SPLIT": self.SPLIT,
+            "ROOT_DIR": os.path.abspath(self.ROOT_DIR),
+            "model_checkpoint": self.model_checkpoint,
+            "speaker_mode": self.speaker_mode,
+            "num_past_utterances": self.num_past_utterances,
+            "num_future_utterances": self.num_future_utterances,
+            "COMET_WIN_SIZE": self.COMET_WIN_SIZE,
+            "FEATURE_DTYPE": self.FEATURE_DTYPE,
+            "CHUNK_STRIDE": self.CHUNK_STRIDE,
+            "sources": [file_fingerprint(self._data_path())],
+        }
+
+    def _data_path(self):
+        return os.path.join(self.ROOT_DIR, self.DATASET, self.SPLIT + ".pkl")
+
+    def _cache_path(self):
+        key = dataset_cache_key(**self._cache_config())
+        return os.path.join(self.CACHE_DIR, self.DATASET, f"{self.SPLIT}-{key}")
+
+    def _load_cache(self):
+        """Load the built samples from CACHE_DIR if this config was seen before."""
+        if not self.CACHE_DIR:
+            return False
+        cached = load_erc_cache(self._cache_path())
+        if cached is None:
+            return False
+        self.inputs_, self.num_truncated, features, dialogue_starts, chunks = cached
+        self.comet_bank = CometFeatureBank(
+            features, dialogue_starts, self.COMET_WIN_SIZE
+        )
+        self.chunk_bank = DialogueChunkBank(*chunks)
+        return True
+
+    def _save_cache(self):
+        if not self.CACHE_DIR:
+            return
+        save_erc_cache(
+            self._cache_path(),
+            self.inputs_,
+            self.num_truncated,
+            self.comet_bank,
+            self.chunk_bank,
+            self._cache_config(),
+        )
 
     def _load_emotions(self):
         """Load the supervised labels"""
@@ -308,241 +580,371 @@ class ErcTextDataset(torch.utils.data.Dataset):
             reps = utt["knowledge_representation"]
             if len(reps) > self.conceptnet_max_num:
                 reps = reps[: self.conceptnet_max_num]
-            reps = torch.Tensor(reps)
+            reps = torch.tensor(np.asarray(reps), dtype=self.feature_dtype)
         else:
-            reps = torch.from_numpy(utt["user_features"])
+            reps = torch.from_numpy(utt["user_features"]).to(self.feature_dtype)
 
         return {"Utterance": utterance, "Emotion": emotion, "comet_features": reps}
 
+    def assemble_context(self, utt_ids, indexes, special_ids):
+        """Concatenate per-utterance token ids into one context input.
+
+        :param utt_ids: Token ids of every utterance in the dialogue, without
+            special tokens.
+        :param indexes: The utterances of the context window, in order.
+        :param special_ids: (bos ids, separator ids, eos ids) of the tokenizer.
+        :return: input_ids and the [start, end) token span of each utterance.
+            The span covers the separator that follows the utterance, exactly
+            like the mask built from tokenizing part_2 separately.
+        """
+        bos_ids, sep_ids, eos_ids = special_ids
+        input_ids = list(bos_ids)
+        spans = []
+        for n, idx_ in enumerate(indexes):
+            start = len(input_ids)
+            input_ids += utt_ids[idx_]
+            if n < len(indexes) - 1:
+                input_ids += sep_ids
+            spans.append((start, len(input_ids)))
+        input_ids += eos_ids
+        return input_ids, spans
+
+    def _special_ids(self, tokenizer):
+        """The (bos, separator, eos) token ids used to join utterances."""
+        empty_ids = tokenizer("")["input_ids"]
+        return (
+            empty_ids[:1],
+            tokenizer(self.sep_token, add_special_tokens=False)["input_ids"],
+            empty_ids[1:],
+        )
+
     def _load_data(self):
         """Load data for EmoryNLP dataset."""
-        tokenizer = AutoTokenizer.from_pretrained(self.model_checkpoint, use_fast=True)
+        with open(self._data_path(), "rb") as f:
+            raw_data = pickle.load(f)
+        self.inputs_, self.num_truncated, dialogue_data = build_samples(
+            self, raw_data, self.num_preprocess_workers
+        )
+        self.comet_bank = CometFeatureBank.from_dialogues(
+            [None if data is None else data[0] for data in dialogue_data],
+            self.COMET_WIN_SIZE,
+        )
+        self.chunk_bank = DialogueChunkBank.from_dialogues(
+            [None if data is None else data[1] for data in dialogue_data]
+        )
+        logging.info(f"number of truncated utterances: {self.num_truncated}")
+
+    def stack_comet_features(self, ues):
+        """Stack the knowledge features of every utterance in a dialogue."""
+        if "conceptnet" in self.ROOT_DIR:
+            comet_features = pad_sequence(
+                [ue["comet_features"] for ue in ues],
+                batch_first=True,
+                padding_value=0.0,
+            )
+            if comet_features.shape[1] < self.conceptnet_max_num:
+                comet_features = torch.cat(
+                    [
+                        comet_features,
+                        torch.zeros(
+                            [
+                                comet_features.shape[0],
+                                self.conceptnet_max_num - comet_features.shape[1],
+                                comet_features.shape[2],
+                            ],
+                            dtype=comet_features.dtype,
+                        ),
+                    ],
+                    dim=1,
+                )
+        else:
+            comet_features = torch.stack([ue["comet_features"] for ue in ues], dim=0)
+            comet_features = torch.index_select(comet_features, 1, self.comet_index)
+        return comet_features
+
+    def _build_dialogue(self, dialogue_id, dialogue, tokenizer):
+        """Build the samples of every target utterance in one dialogue.
+
+        The knowledge features and the encoder chunks of the dialogue are built
+        once and returned alongside the samples; each sample only refers to its
+        window by dialogue id and target offset.
+        """
         max_model_input_size = tokenizer.max_model_input_sizes[self.model_checkpoint]
+        special_ids = self._special_ids(tokenizer)
         num_truncated = 0
         inputs = []
-        with open(
-            os.path.join(self.ROOT_DIR, self.DATASET, self.SPLIT + ".pkl"), "rb"
-        ) as f:
-            raw_data = pickle.load(f)
-            for dialogue in raw_data:
-                ues = [
-                    self.load_utterance_speaker_emotion(utt, self.speaker_mode)
-                    for utt in dialogue
-                ]
-                num_tokens = [
-                    len(tokenizer(ue["Utterance"])["input_ids"]) for ue in ues
-                ]
-                for idx, ue in enumerate(ues):
-                    if ue["Emotion"] not in list(self.emotion2id.keys()):
-                        continue
-
-                    label = self.emotion2id[ue["Emotion"]]
-
-                    indexes = [idx]
-                    indexes_past = [
-                        i
-                        for i in range(idx - 1, idx - self.num_past_utterances - 1, -1)
-                    ]
-                    indexes_future = [
-                        i
-                        for i in range(idx + 1, idx + self.num_future_utterances + 1, 1)
-                    ]
-
-                    offset = 0
-                    if len(indexes_past) < len(indexes_future):
-                        for _ in range(len(indexes_future) - len(indexes_past)):
-                            indexes_past.append(None)
-                    elif len(indexes_past) > len(indexes_future):
-                        for _ in range(len(indexes_past) - len(indexes_future)):
-                            indexes_future.append(None)
-
-                    for i, j in zip(indexes_past, indexes_future):
-                        if i is not None and i >= 0:
-                            indexes.insert(0, i)
-                            offset += 1
-                            if (
-                                sum([num_tokens[idx_] + 2 for idx_ in indexes]) - 2
-                                > max_model_input_size
-                            ):
-                                del indexes[0]
-                                offset -= 1
-                                num_truncated += 1
-                                break
-                        if j is not None and j < len(ues):
-                            indexes.append(j)
-                            if (
-                                sum([num_tokens[idx_] + 2 for idx_ in indexes]) - 2
-                                > max_model_input_size
-                            ):
-                                del indexes[-1]
-                                num_truncated += 1
-                                break
-
-                    utterances = [ues[idx_]["Utterance"] for idx_ in indexes]
-
-                    if "conceptnet" in self.ROOT_DIR:
-                        comet_features = pad_sequence(
-                            [ues[idx_]["comet_features"] for idx_ in indexes],
-                            batch_first=True,
-                            padding_value=0.0,
+        ues = [
+            self.load_utterance_speaker_emotion(utt, self.speaker_mode)
+            for utt in dialogue
+        ]
+        if self.tokenize_once:
+            # One batched tokenizer call per dialogue; every context window is
+            # assembled from these ids below.
+            utt_ids = (
+                tokenizer([ue["Utterance"] for ue in ues])["input_ids"] if ues else []
+            )
+            num_tokens = [len(ids) for ids in utt_ids]
+            utt_ids = [ids[1:-1] for ids in utt_ids]
+        else:
+            utt_ids = [tokenizer(ue["Utterance"])["input_ids"] for ue in ues]
+            num_tokens = [len(ids) for ids in utt_ids]
+            utt_ids = [ids[1:-1] for ids in utt_ids]
+        if ues:
+            dialogue_data = (
+                self.stack_comet_features(ues),
+                self.chunk_dialogue(utt_ids, special_ids, max_model_input_size),
+            )
+        else:
+            dialogue_data = None
+        for idx, ue in enumerate(ues):
+            if ue["Emotion"] not in list(self.emotion2id.keys()):
+                continue
+
+            label = self.emotion2id[ue["Emotion"]]
+
+            indexes = [idx]
+            indexes_past = [
+                i for i in range(idx - 1, idx - self.num_past_utterances - 1, -1)
+            ]
+            indexes_future = [
+                i for i in range(idx + 1, idx + self.num_future_utterances + 1, 1)
+            ]
+
+            offset = 0
+            if len(indexes_past) < len(indexes_future):
+                for _ in range(len(indexes_future) - len(indexes_past)):
+                    indexes_past.append(None)
+            elif len(indexes_past) > len(indexes_future):
+                for _ in range(len(indexes_past) - len(indexes_future)):
+                    indexes_future.append(None)
+
+            for i, j in zip(indexes_past, indexes_future):
+                if i is not None and i >= 0:
+                    indexes.insert(0, i)
+                    offset += 1
+                    if (
+                        sum([num_tokens[idx_] + 2 for idx_ in indexes]) - 2
+                        > max_model_input_size
+                    ):
+                        del indexes[0]
+                        offset -= 1
+                        num_truncated += 1
+                        break
+                if j is not None and j < len(ues):
+                    indexes.append(j)
+                    if (
+                        sum([num_tokens[idx_] + 2 for idx_ in indexes]) - 2
+                        > max_model_input_size
+                    ):
+                        del indexes[-1]
+                        num_truncated += 1
+                        break
+
+            utterances = [ues[idx_]["Utterance"] for idx_ in indexes]
+
+            all_sent_labels = [
+                self.emotion2id[ues[idx_]["Emotion"]]
+                if ues[idx_]["Emotion"] in list(self.emotion2id.keys())
+                else 0
+                for idx_ in indexes
+            ]
+            comet_features, final_pos, comet_pos = self.prepare_comet_features(
+                len(indexes), all_sent_labels, offset
+            )
+            comet_features["dialogue"] = dialogue_id
+            comet_features["offset"] = idx
+            if len(utterances) == 1:
+                final_part_2 = utterances[offset] + self.sep_token
+                current_utt = utterances[offset]
+
+                if self.tokenize_once:
+                    input_ids = (
+                        special_ids[0] + utt_ids[idx] + special_ids[1] + special_ids[2]
+                    )
+                else:
+                    input_ids_attention_mask_part_2 = tokenizer(final_part_2)
+                    input_ids = input_ids_attention_mask_part_2["input_ids"]
+                attention_mask = [1] * len(input_ids)
+                # The lone utterance covers the whole input, special tokens included.
+                utt_pos_spans = self.pad_pos_spans([[0, len(input_ids)]], final_pos)
+            elif self.tokenize_once:
+                input_ids, spans = self.assemble_context(utt_ids, indexes, special_ids)
+                attention_mask = [1] * len(input_ids)
+                utt_pos_spans = self.pad_pos_spans(
+                    [list(spans[cuu_offset]) for cuu_offset in range(*comet_pos)],
+                    final_pos,
+                )
+            else:
+                utt_pos_spans = []
+                for cuu_offset in range(comet_pos[0], comet_pos[1]):
+                    if cuu_offset != 0:
+                        part_1 = (
+                            self.sep_token.join(utterances[:cuu_offset])
+                            + self.sep_token
                         )
-                        if comet_features.shape[1] < self.conceptnet_max_num:
-                            comet_features = torch.cat(
-                                [
-                                    comet_features,
-                                    torch.zeros(
-                                        [
-                                            comet_features.shape[0],
-                                            self.conceptnet_max_num
-                                            - comet_features.shape[1],
-                                            comet_features.shape[2],
-                                        ]
-                                    ),
-                                ],
-                                dim=1,
-                            )
                     else:
-                        comet_features = torch.stack(
-                            [ues[idx_]["comet_features"] for idx_ in indexes], dim=0
-                        )
-                        comet_features = torch.index_select(
-                            comet_features, 1, self.comet_index
+                        part_1 = self.sep_token.join(utterances[:cuu_offset])
+                    if cuu_offset < len(utterances) - 1:
+                        part_2 = utterances[cuu_offset] + self.sep_token
+                    else:
+                        part_2 = utterances[cuu_offset]
+                    part_3 = self.sep_token.join(utterances[cuu_offset + 1 :])
+
+                    input_ids_attention_mask_part_1 = tokenizer(part_1)
+                    input_ids_attention_mask_part_2 = tokenizer(part_2)
+                    input_ids_attention_mask_part_3 = tokenizer(part_3)
+
+                    cuu_start = len(input_ids_attention_mask_part_1["input_ids"]) - 1
+                    cuu_len = len(input_ids_attention_mask_part_2["input_ids"]) - 2
+                    utt_pos_spans.append([cuu_start, cuu_start + cuu_len])
+                    # print(input_ids_attention_mask_part_3['input_ids'])
+                    # print(input_ids_attention_mask_part_3['attention_mask'])
+                    if cuu_offset == offset:
+                        current_utt = utterances[cuu_offset]
+                        input_ids = (
+                            input_ids_attention_mask_part_1["input_ids"][:-1]
+                            + input_ids_attention_mask_part_2["input_ids"][1:-1]
+                            + input_ids_attention_mask_part_3["input_ids"][1:]
                         )
+                        attention_mask = [1] * len(input_ids)
+                utt_pos_spans = self.pad_pos_spans(utt_pos_spans, final_pos)
+
+            for start, end in utt_pos_spans:
+                assert 0 <= start <= end <= len(input_ids)
+            if self.num_future_utterances == 0:
+                assert self.COMET_WIN_SIZE + 1 == len(utt_pos_spans)
+            else:
+                assert 2 * self.COMET_WIN_SIZE + 1 == len(utt_pos_spans)
+
+            if self.tokenize_once:
+                current_ids = special_ids[0] + utt_ids[idx] + special_ids[2]
+                current_masks = [1] * len(current_ids)
+            else:
+                current_utt_mask = tokenizer(current_utt)
+                current_ids = current_utt_mask["input_ids"]
+                current_masks = current_utt_mask["attention_mask"]
+            input_ = {
+                "input_ids": input_ids,
+                "attention_mask": attention_mask,
+                "pos_spans": utt_pos_spans,
+                "comet_features": comet_features,
+                "label": label,
+                "target utterance": {
+                    "ids": current_ids,
+                    "masks": current_masks,
+                },
+            }
+            inputs.append(input_)
+        return inputs, num_truncated, dialogue_data
+
+    def chunk_dialogue(self, utt_ids, special_ids, max_len):
+        """Split a dialogue into encoder inputs of at most max_len tokens.
+
+        Chunks are cut at utterance boundaries; an utterance that does not fit
+        into a chunk on its own is truncated. With a CHUNK_STRIDE, the chunks
+        overlap instead, see stride_dialogue.
+        :return: The input_ids of each chunk and the [chunk, start, end) span of
+            every utterance.
+        """
+        if self.CHUNK_STRIDE > 0:
+            return self.stride_dialogue(utt_ids, special_ids, max_len)
+        bos_ids, sep_ids, eos_ids = special_ids
+        budget = max_len - len(bos_ids) - len(eos_ids)
+        utt_ids = [ids[:budget] for ids in utt_ids]
+        groups = [[]]
+        length = 0
+        for idx_, ids in enumerate(utt_ids):
+            if groups[-1] and length + len(sep_ids) + len(ids) > budget:
+                groups.append([])
+            if groups[-1]:
+                length += len(sep_ids) + len(ids)
+            else:
+                length = len(ids)
+            groups[-1].append(idx_)
+        chunks = []
+        spans = []
+        for indexes in groups:
+            input_ids, chunk_spans = self.assemble_context(
+                utt_ids, indexes, special_ids
+            )
+            spans += [[len(chunks), start, end] for start, end in chunk_spans]
+            chunks.append(input_ids)
+        return chunks, spans
+
+    def stride_dialogue(self, utt_ids, special_ids, max_len):
+        """Split a dialogue into overlapping windows of at most max_len tokens.
+
+        A window starts every CHUNK_STRIDE tokens of the concatenated dialogue,
+        so no context is dropped however long the dialogue is. Each utterance is
+        pooled from the window that holds most of it with the most context on
+        both sides.
+        :return: The input_ids of each chunk and the [chunk, start, end) span of
+            every utterance.
+        """
+        bos_ids, sep_ids, eos_ids = special_ids
+        budget = max_len - len(bos_ids) - len(eos_ids)
+        # A longer stride would leave tokens between the windows that no
+        # utterance can be pooled from.
+        if not 0 < self.CHUNK_STRIDE <= budget:
+            raise ValueError(
+                "CHUNK_STRIDE must be in [1, {}], got {}".format(
+                    budget, self.CHUNK_STRIDE
+                )
+            )
+        body, body_spans = self.assemble_context(
+            utt_ids, list(range(len(utt_ids))), ([], sep_ids, [])
+        )
+        if len(body) <= budget:
+            starts = [0]
+        else:
+            starts = list(range(0, len(body) - budget, self.CHUNK_STRIDE))
+            starts.append(len(body) - budget)
+        chunks = [bos_ids + body[start : start + budget] + eos_ids for start in starts]
 
-                    all_sent_labels = [
-                        self.emotion2id[ues[idx_]["Emotion"]]
-                        if ues[idx_]["Emotion"] in list(self.emotion2id.keys())
-                        else 0
-                        for idx_ in indexes
-                    ]
-                    comet_features, final_pos, comet_pos = self.prepare_comet_features(
-                        comet_features, all_sent_labels, offset
-                    )
-                    if len(utterances) == 1:
-                        final_part_2 = utterances[offset] + self.sep_token
-                        current_utt = utterances[offset]
+        spans = []
+        for utt_start, utt_end in body_spans:
 
-                        input_ids_attention_mask_part_2 = tokenizer(final_part_2)
-                        input_ids = input_ids_attention_mask_part_2["input_ids"]
-                        attention_mask = [1] * len(input_ids)
-                        if self.num_future_utterances == 0:
-                            utt_pos_masks = (
-                                [[0] * len(input_ids)] * final_pos[0]
-                                + [attention_mask]
-                                + [[0] * len(input_ids)]
-                                * (self.COMET_WIN_SIZE + 1 - final_pos[1])
-                            )
-                        else:
-                            utt_pos_masks = (
-                                [[0] * len(input_ids)] * final_pos[0]
-                                + [attention_mask]
-                                + [[0] * len(input_ids)]
-                                * (2 * self.COMET_WIN_SIZE + 1 - final_pos[1])
-                            )
-                    else:
-                        utt_pos_masks = []
-                        for cuu_offset in range(comet_pos[0], comet_pos[1]):
-                            if cuu_offset != 0:
-                                part_1 = (
-                                    self.sep_token.join(utterances[:cuu_offset])
-                                    + self.sep_token
-                                )
-                            else:
-                                part_1 = self.sep_token.join(utterances[:cuu_offset])
-                            if cuu_offset < len(utterances) - 1:
-                                part_2 = utterances[cuu_offset] + self.sep_token
-                            else:
-                                part_2 = utterances[cuu_offset]
-                            part_3 = self.sep_token.join(utterances[cuu_offset + 1 :])
-
-                            input_ids_attention_mask_part_1 = tokenizer(part_1)
-                            input_ids_attention_mask_part_2 = tokenizer(part_2)
-                            input_ids_attention_mask_part_3 = tokenizer(part_3)
-
-                            cuu_mask = (
-                                [0]
-                                * (
-                                    len(
-                                        input_ids_attention_mask_part_1[
-                                            "attention_mask"
-                                        ]
-                                    )
-                                    - 1
-                                )
-                                + input_ids_attention_mask_part_2["attention_mask"][
-                                    1:-1
-                                ]
-                                + [0]
-                                * (
-                                    len(
-                                        input_ids_attention_mask_part_3[
-                                            "attention_mask"
-                                        ]
-                                    )
-                                    - 1
-                                )
-                            )
-                            utt_pos_masks.append(cuu_mask)
-                            # print(input_ids_attention_mask_part_3['input_ids'])
-                            # print(input_ids_attention_mask_part_3['attention_mask'])
-                            if cuu_offset == offset:
-                                current_utt = utterances[cuu_offset]
-                                input_ids = (
-                                    input_ids_attention_mask_part_1["input_ids"][:-1]
-                                    + input_ids_attention_mask_part_2["input_ids"][1:-1]
-                                    + input_ids_attention_mask_part_3["input_ids"][1:]
-                                )
-                                attention_mask = [1] * len(input_ids)
-                        if self.num_future_utterances == 0:
-                            utt_pos_masks = (
-                                [[0] * len(input_ids)] * final_pos[0]
-                                + utt_pos_masks
-                                + [[0] * len(input_ids)]
-                                * (self.COMET_WIN_SIZE + 1 - final_pos[1])
-                            )
-                        else:
-                            utt_pos_masks = (
-                                [[0] * len(input_ids)] * final_pos[0]
-                                + utt_pos_masks
-                                + [[0] * len(input_ids)]
-                                * (2 * self.COMET_WIN_SIZE + 1 - final_pos[1])
-                            )
-
-                    for k in utt_pos_masks:
-                        assert len(k) == len(input_ids)
-                    if self.num_future_utterances == 0:
-                        assert self.COMET_WIN_SIZE + 1 == len(utt_pos_masks)
-                    else:
-                        assert 2 * self.COMET_WIN_SIZE + 1 == len(utt_pos_masks)
-
-                    current_utt_mask = tokenizer(current_utt)
-                    current_ids = current_utt_mask["input_ids"]
-                    current_masks = current_utt_mask["attention_mask"]
-                    input_ = {
-                        "input_ids": input_ids,
-                        "attention_mask": attention_mask,
-                        "pos_masks": utt_pos_masks,
-                        "comet_features": comet_features,
-                        "label": label,
-                        "target utterance": {
-                            "ids": current_ids,
-                            "masks": current_masks,
-                        },
-                    }
-                    inputs.append(input_)
-            logging.info(f"number of truncated utterances: {num_truncated}")
-            self.inputs_ = inputs
-
-    def prepare_comet_features(self, comet_feature, all_sent_labels, off_set):
-        if self.num_future_utterances == 0:
-            comet_sent_labels = [-1] * (self.COMET_WIN_SIZE + 1)
-            final_features = torch.zeros(
+            def score(chunk):
+                start, end = starts[chunk], starts[chunk] + budget
+                overlap = min(utt_end, end) - max(utt_start, start)
+                return overlap, min(utt_start - start, end - utt_end)
+
+            chunk = max(range(len(starts)), key=score)
+            start, end = starts[chunk], starts[chunk] + budget
+            spans.append(
                 [
-                    self.COMET_WIN_SIZE + 1,
-                    comet_feature.shape[1],
-                    comet_feature.shape[2],
+                    chunk,
+                    max(utt_start, start) - start + len(bos_ids),
+                    min(utt_end, end) - start + len(bos_ids),
                 ]
             )
+        return chunks, spans
+
+    def pad_pos_spans(self, utt_pos_spans, final_pos):
+        """Pad the utterance token spans with empty slots to the full COMET window.
+
+        Each slot holds the [start, end) token span of its utterance in
+        input_ids; the model expands the spans into position masks on device.
+        """
+        if self.num_future_utterances == 0:
+            num_slots = self.COMET_WIN_SIZE + 1
+        else:
+            num_slots = 2 * self.COMET_WIN_SIZE + 1
+        return (
+            [[0, 0] for _ in range(final_pos[0])]
+            + utt_pos_spans
+            + [[0, 0] for _ in range(num_slots - final_pos[1])]
+        )
+
+    def prepare_comet_features(self, num_context, all_sent_labels, off_set):
+        """Locate the COMET window of a target inside its context.
+
+        Slot w of the window holds utterance `offset - COMET_WIN_SIZE + w` of the
+        dialogue; slots outside the context are masked out. The features
+        themselves are gathered per batch by CometFeatureBank.
+        """
+        if self.num_future_utterances == 0:
+            comet_sent_labels = [-1] * (self.COMET_WIN_SIZE + 1)
             comet_mask = torch.ones(self.COMET_WIN_SIZE + 1)
             comet_left = off_set - self.COMET_WIN_SIZE
             comet_right = off_set + 1
@@ -554,13 +956,6 @@ class ErcTextDataset(torch.utils.data.Dataset):
                 final_left = self.COMET_WIN_SIZE - off_set
         else:
             comet_sent_labels = [-1] * (2 * self.COMET_WIN_SIZE + 1)
-            final_features = torch.zeros(
-                [
-                    2 * self.COMET_WIN_SIZE + 1,
-                    comet_feature.shape[1],
-                    comet_feature.shape[2],
-                ]
-            )
             comet_mask = torch.ones(2 * self.COMET_WIN_SIZE + 1)
             comet_left = off_set - self.COMET_WIN_SIZE
             comet_right = off_set + self.COMET_WIN_SIZE + 1
@@ -570,24 +965,20 @@ class ErcTextDataset(torch.utils.data.Dataset):
                 comet_mask[0 : self.COMET_WIN_SIZE - off_set] = 0.0
                 comet_left = 0
                 final_left = self.COMET_WIN_SIZE - off_set
-            if comet_feature.shape[0] < off_set + self.COMET_WIN_SIZE + 1:
+            if num_context < off_set + self.COMET_WIN_SIZE + 1:
                 comet_mask[
                     self.COMET_WIN_SIZE
                     - off_set
-                    + comet_feature.shape[0] : 2 * self.COMET_WIN_SIZE
+                    + num_context : 2 * self.COMET_WIN_SIZE
                     + 1
                 ] = 0.0
-                comet_right = comet_feature.shape[0]
-                final_right = self.COMET_WIN_SIZE - off_set + comet_feature.shape[0]
-        final_features[final_left:final_right,] = comet_feature[
-            comet_left:comet_right,
-        ]
+                comet_right = num_context
+                final_right = self.COMET_WIN_SIZE - off_set + num_context
         comet_sent_labels[final_left:final_right] = all_sent_labels[
             comet_left:comet_right
         ]
         return (
             {
-                "feature": final_features,
                 "mask": comet_mask,
                 "comet_sent_labels": comet_sent_labels,
             },
@@ -613,6 +1004,8 @@ class RECCONTextDataset(torch.utils.data.Dataset):
         ROOT_DIR="./comet_enhanced_data",
         ONLY_UPTO=False,
         SEED=0,
+        FEATURE_DTYPE="float32",
+        num_preprocess_workers=1,
     ):
         """Initialize emotion casual entailment text modality dataset class."""
 
@@ -624,6 +1017,9 @@ class RECCONTextDataset(torch.utils.data.Dataset):
         self.emotion2id = get_emotion2id(self.DATASET)
         self.ONLY_UPTO = ONLY_UPTO
         self.SEED = SEED
+        self.FEATURE_DTYPE = FEATURE_DTYPE
+        self.feature_dtype = get_feature_dtype(FEATURE_DTYPE)
+        self.num_preprocess_workers = num_preprocess_workers
         self.conceptnet_max_num = 15
         if "roberta" in model_checkpoint:
             self.sep_token = "</s></s>"
@@ -655,10 +1051,6 @@ class RECCONTextDataset(torch.utils.data.Dataset):
 
     def _load_data(self):
         """Load data for EmoryNLP dataset."""
-        tokenizer = AutoTokenizer.from_pretrained(self.model_checkpoint, use_fast=True)
-        max_model_input_size = tokenizer.max_model_input_sizes[self.model_checkpoint]
-        num_truncated = 0
-        inputs = []
         with open(
             os.path.join(self.ROOT_DIR, self.DATASET, self.SPLIT + ".pkl"), "rb"
         ) as f:
@@ -670,65 +1062,74 @@ class RECCONTextDataset(torch.utils.data.Dataset):
                 ids,
                 extracted_data,
             ) = pickle.load(f)
-            for id in ids:
-                dialogue = target_context[id]
-                speaker = speakers[id]
-                cause_label = cause_labels[id]
-                emotion = emotions[id]
-                comet_data = extracted_data[id]
-                ues = self.load_utterance_speaker(dialogue, speaker, self.speaker_mode)
-                ue = self.sep_token.join(ues)
-                k = tokenizer(ue)
-                tokenized_utt = k["input_ids"]
-                input_mask = k["attention_mask"]
-                length = len(tokenized_utt)
-
-                start = 1
-                while length > max_model_input_size:
-                    ue = self.sep_token.join(ues[start:])
-                    k = tokenizer(ue)
-                    tokenized_utt = k["input_ids"]
-                    input_mask = k["attention_mask"]
-                    length = len(tokenized_utt)
-
-                    cause_label = cause_label[1:]
-                    emotion = emotion[1:]
-                    comet_data = comet_data[1:]
-
-                    start += 1
-                assert len(ues) - start + 1 == len(cause_label)
-                utt_masks = torch.zeros([len(cause_label), len(tokenized_utt)])
-                cuu_utt = 0
-                for i in range(1, len(tokenized_utt)):
-                    utt_masks[cuu_utt, i] = 1
-                    if tokenized_utt[i] == tokenized_utt[i - 1] == 2:
-                        cuu_utt += 1
-                assert cuu_utt + 1 == len(cause_label)
-                if "conceptnet" in self.ROOT_DIR:
-                    new_comet_data = []
-                    for item in comet_data:
-                        if len(item) >= self.conceptnet_max_num:
-                            new_comet_data.append(item[: self.conceptnet_max_num])
-                        else:
-                            new_comet_data.append(
-                                item
-                                + [[0.0] * len(item[0])]
-                                * (self.conceptnet_max_num - len(item))
-                            )
-                else:
-                    new_comet_data = comet_data
-                input_ = {
-                    "input_ids": tokenized_utt,
-                    "attention_mask": input_mask,
-                    "pos_masks": utt_masks,
-                    "comet_features": new_comet_data,
-                    "label": cause_label,
-                    "emolabel": emotion,
-                }
-                inputs.append(input_)
-
-            logging.info(f"number of truncated utterances: {num_truncated}")
-            self.inputs_ = inputs
+        dialogues = [
+            (
+                target_context[id],
+                speakers[id],
+                cause_labels[id],
+                emotions[id],
+                extracted_data[id],
+            )
+            for id in ids
+        ]
+        self.inputs_, num_truncated, _ = build_samples(
+            self, dialogues, self.num_preprocess_workers
+        )
+        logging.info(f"number of truncated utterances: {num_truncated}")
+
+    def _build_dialogue(self, dialogue_id, dialogue, tokenizer):
+        """Build the sample of one dialogue."""
+        max_model_input_size = tokenizer.max_model_input_sizes[self.model_checkpoint]
+        dialogue, speaker, cause_label, emotion, comet_data = dialogue
+        ues = self.load_utterance_speaker(dialogue, speaker, self.speaker_mode)
+        ue = self.sep_token.join(ues)
+        k = tokenizer(ue)
+        tokenized_utt = k["input_ids"]
+        input_mask = k["attention_mask"]
+        length = len(tokenized_utt)
+
+        start = 1
+        while length > max_model_input_size:
+            ue = self.sep_token.join(ues[start:])
+            k = tokenizer(ue)
+            tokenized_utt = k["input_ids"]
+            input_mask = k["attention_mask"]
+            length = len(tokenized_utt)
+
+            cause_label = cause_label[1:]
+            emotion = emotion[1:]
+            comet_data = comet_data[1:]
+
+            start += 1
+        assert len(ues) - start + 1 == len(cause_label)
+        utt_masks = torch.zeros([len(cause_label), len(tokenized_utt)])
+        cuu_utt = 0
+        for i in range(1, len(tokenized_utt)):
+            utt_masks[cuu_utt, i] = 1
+            if tokenized_utt[i] == tokenized_utt[i - 1] == 2:
+                cuu_utt += 1
+        assert cuu_utt + 1 == len(cause_label)
+        if "conceptnet" in self.ROOT_DIR:
+            new_comet_data = torch.zeros(
+                [len(comet_data), self.conceptnet_max_num, len(comet_data[0][0])],
+                dtype=self.feature_dtype,
+            )
+            for i, item in enumerate(comet_data):
+                item = np.asarray(item[: self.conceptnet_max_num])
+                new_comet_data[i, : len(item)] = torch.from_numpy(item)
+        else:
+            new_comet_data = torch.from_numpy(np.stack(comet_data)).to(
+                self.feature_dtype
+            )
+        input_ = {
+            "input_ids": tokenized_utt,
+            "attention_mask": input_mask,
+            "pos_masks": utt_masks,
+            "comet_features": new_comet_data,
+            "label": cause_label,
+            "emolabel": emotion,
+        }
+        return [input_], 0, None
 
     def __len__(self):
         return len(self.inputs_)